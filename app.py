@@ -1,13 +1,16 @@
 # app.py (Fixed WebRTC Implementation)
 
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response, send_file, abort
 from flask_socketio import SocketIO, emit
 import serial
 import threading
 import time
-from datetime import datetime
+from datetime import datetime, timezone
 import sqlite3
 import os
+import sys
+import subprocess
+import signal
 from contextlib import contextmanager
 import cv2
 import asyncio
@@ -17,160 +20,2530 @@ from aiortc.contrib.media import MediaStreamTrack
 import av
 import uuid
 import logging
+import queue
+import random
+import atexit
+import collections
+import re
+import itertools
+import gzip
+import json
+import csv
+import io
+import zlib
+import bisect
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from fractions import Fraction
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# --- Chế độ server ---
+# RFID_ASYNC_MODE: 'threading' (mặc định, Werkzeug, mỗi client một thread) hoặc
+# 'gevent' cho production: client là greenlet nên giữ được hàng nghìn dashboard.
+ASYNC_MODE = os.environ.get('RFID_ASYNC_MODE', 'threading')
+# Message queue chung (redis://... hoặc URL kombu) và số worker Socket.IO phụ
+# (socket_worker.py) giữ kết nối dashboard thay cho gateway
+MESSAGE_QUEUE = os.environ.get('RFID_MESSAGE_QUEUE')
+SOCKET_WORKERS = int(os.environ.get('RFID_SOCKET_WORKERS', 0))
+SERVER_PORT = int(os.environ.get('RFID_PORT', 5000))
+# Số native thread gevent dùng cho các lời gọi chặn từ request (chờ camera, chờ frame)
+BLOCKING_THREADS = 64
+if ASYNC_MODE == 'gevent':
+    import gevent
+
+class ServerSocketIO(SocketIO):
+    """SocketIO cho phép emit từ thread thường khi server chạy gevent.
+    
+    Không monkey-patch: hub gevent và mọi client chỉ sống trên thread chính,
+    còn serial, camera, ghi DB và aiortc vẫn là thread thật vì chúng chặn
+    trong code C. Emit từ các thread đó được xếp hàng rồi chuyển sang hub
+    bằng run_callback_threadsafe, một greenlet emit thật theo đúng thứ tự.
+    """
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.hub_thread = threading.get_ident()
+        self.pending = collections.deque()
+        self.drain_scheduled = False
+        if ASYNC_MODE == 'gevent':
+            self.hub = gevent.get_hub()
+            self.hub.threadpool.maxsize = BLOCKING_THREADS
+    
+    def emit(self, *args, **kwargs):
+        if ASYNC_MODE != 'gevent' or threading.get_ident() == self.hub_thread:
+            return super().emit(*args, **kwargs)
+        self.pending.append((args, kwargs))
+        if not self.drain_scheduled:
+            self.drain_scheduled = True
+            self.hub.loop.run_callback_threadsafe(gevent.spawn, self._drain)
+    
+    def _drain(self):
+        # Bỏ cờ trước khi rút để emit đến sau đó luôn được lên lịch lại
+        self.drain_scheduled = False
+        while self.pending:
+            args, kwargs = self.pending.popleft()
+            try:
+                super().emit(*args, **kwargs)
+            except Exception as e:
+                logger.error(f"Lỗi emit {args[0]}: {e}")
+
+def make_client_manager():
+    """Manager chỉ-ghi lên message queue: gateway phát sự kiện, worker giữ client.
+    
+    Gateway không nghe queue (luồng nghe sẽ chặn hub gevent), nên ở chế độ này
+    client Socket.IO phải nối vào worker; trang chủ tự giao cổng worker.
+    """
+    import socketio as socketio_server
+    manager_class = socketio_server.RedisManager if MESSAGE_QUEUE.startswith(('redis://', 'rediss://')) else socketio_server.KombuManager
+    # Cùng channel mặc định với Flask-SocketIO ở phía worker
+    return manager_class(MESSAGE_QUEUE, channel='flask-socketio', write_only=True)
+
+def run_blocking(function, *args):
+    """Gọi hàm chặn trên native thread (threadpool của gevent) để không giữ hub"""
+    if ASYNC_MODE == 'gevent':
+        return socketio.hub.threadpool.apply(function, args)
+    return function(*args)
+
+def iter_blocking(iterable):
+    """Duyệt iterator chặn (đọc DB/file) từng phần tử qua run_blocking"""
+    iterator = iter(iterable)
+    done = object()
+    while True:
+        item = run_blocking(next, iterator, done)
+        if item is done:
+            return
+        yield item
+
 # --- Flask và SocketIO Setup ---
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'webrtc_rfid_secret_key'
-socketio = SocketIO(app, async_mode='threading', cors_allowed_origins="*")
+socketio_options = {'client_manager': make_client_manager()} if MESSAGE_QUEUE else {}
+socketio = ServerSocketIO(app, async_mode=ASYNC_MODE, cors_allowed_origins="*", **socketio_options)
+
+# Đồng hồ chung cho pts của mọi video track (90kHz như RTP)
+VIDEO_CLOCK_RATE = 90000
+VIDEO_TIME_BASE = Fraction(1, VIDEO_CLOCK_RATE)
+VIDEO_CLOCK_START = time.monotonic()
+
+def video_pts(timestamp):
+    """Đổi thời điểm time.monotonic() sang pts theo VIDEO_TIME_BASE"""
+    return int((timestamp - VIDEO_CLOCK_START) * VIDEO_CLOCK_RATE)
+
+def bgr_to_i420(frame):
+    """Chuyển frame BGR sang buffer yuv420p (I420) - định dạng encoder cần"""
+    height, width = frame.shape[:2]
+    if height % 2 or width % 2:
+        # I420 yêu cầu kích thước chẵn
+        frame = frame[:height - height % 2, :width - width % 2]
+    i420 = cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_I420)
+    i420.flags.writeable = False
+    return i420
+
+def scaled_size(width, height, max_width=0, max_height=0):
+    """Kích thước (chẵn) lớn nhất vừa trong max_width x max_height, giữ tỉ lệ"""
+    scale = 1.0
+    if max_width:
+        scale = min(scale, max_width / width)
+    if max_height:
+        scale = min(scale, max_height / height)
+    return max(2, int(width * scale) & ~1), max(2, int(height * scale) & ~1)
+
+def parse_video_profile(data):
+    """Đọc max_width/max_height/max_fps từ offer, bỏ qua giá trị không hợp lệ"""
+    profile = {}
+    for key in ('max_width', 'max_height', 'max_fps'):
+        try:
+            profile[key] = max(0, int(data.get(key) or 0))
+        except (TypeError, ValueError):
+            profile[key] = 0
+    return profile
+
+def profile_bounds(profile):
+    """(max_width, max_height) để thu nhỏ frame, None nếu không giới hạn"""
+    if profile['max_width'] or profile['max_height']:
+        return profile['max_width'], profile['max_height']
+    return None
+
+def wake_futures(futures):
+    """Chạy trên event loop: hoàn thành các future chờ frame"""
+    for future in futures:
+        if not future.done():
+            future.set_result(None)
+
+def make_no_signal_i420():
+    frame = np.zeros((480, 640, 3), dtype=np.uint8)
+    cv2.putText(frame, "No Signal", (250, 240), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+    return bgr_to_i420(frame)
+
+NO_SIGNAL_I420 = make_no_signal_i420()
+
+# Số slot trong ring buffer frame của mỗi CameraReader
+FRAME_RING_SIZE = 4
+# Không ai xin frame trong khoảng này thì reader chỉ grab() chứ không decode
+CAMERA_IDLE_AFTER = 2.0
+# Backoff khi kết nối lại camera: 1, 2, 4, ... tối đa 30 giây, không bao giờ bỏ cuộc
+RECONNECT_BASE_DELAY = 1.0
+RECONNECT_MAX_DELAY = 30.0
+# Phát hiện thay đổi cảnh trên kênh Y thu nhỏ 1/8 mỗi chiều, một lần cho mỗi frame nguồn
+SCENE_DOWNSCALE = 8
+# Điểm ảnh lệch quá mức này (0..255) so với frame trước mới tính là thay đổi, lọc nhiễu cảm biến
+SCENE_PIXEL_DELTA = 20
+# Tỉ lệ điểm ảnh thay đổi từ mức này trở lên là có chuyển động
+SCENE_CHANGE_THRESHOLD = 0.005
+# Giữ full fps thêm chừng này giây sau chuyển động hoặc lượt quét thẻ cuối
+SCENE_MOTION_HOLD = 3.0
+# Bucket cho histogram điểm thay đổi cảnh, để chỉnh ngưỡng theo số liệu thật
+CHANGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5)
+# Mức chất lượng JPEG cho luồng HTTP: làm tròn theo bước để cache dùng chung được
+JPEG_QUALITY_STEP = 10
+JPEG_DEFAULT_QUALITY = 70
+
+def parse_jpeg_quality(value):
+    """Chất lượng JPEG từ query string, làm tròn về một trong các mức 10..90"""
+    try:
+        quality = int(value)
+    except (TypeError, ValueError):
+        return JPEG_DEFAULT_QUALITY
+    quality = round(quality / JPEG_QUALITY_STEP) * JPEG_QUALITY_STEP
+    return min(90, max(10, quality))
 
 # Dictionary để lưu các kết nối WebRTC
 peer_connections = {}
+# connection_id -> CameraReader (dùng chung qua capture_hub)
 camera_readers = {}
 
+class FrameRing:
+    """Ring buffer frame cấp phát sẵn: một writer, nhiều reader, không copy.
+
+    Writer decode thẳng vào buffer của slot kế tiếp rồi publish (seq, view)
+    bằng một phép gán tuple (atomic dưới GIL) nên reader không cần lock.
+    View trả về là read-only và hợp lệ cho tới khi writer quay vòng lại slot
+    đó (size - 1 frame sau); reader cần giữ lâu hơn thì tự copy hoặc kiểm
+    tra bằng is_current().
+    """
+    
+    def __init__(self, size=4):
+        self.size = size
+        self.buffers = [None] * size
+        self.views = [None] * size
+        self.latest = (0, None)
+        self.next_seq = 1
+    
+    def write_buffer(self):
+        """Buffer của slot kế tiếp để cap.read() decode vào (None ở vòng đầu)"""
+        return self.buffers[self.next_seq % self.size]
+    
+    def publish(self, frame):
+        """Publish frame vừa decode, trả về seq của nó"""
+        seq = self.next_seq
+        index = seq % self.size
+        if frame is not self.buffers[index]:
+            # Lần đầu hoặc kích thước frame thay đổi: OpenCV đã cấp buffer mới
+            view = frame.view()
+            view.flags.writeable = False
+            self.buffers[index] = frame
+            self.views[index] = view
+        self.latest = (seq, self.views[index])
+        self.next_seq = seq + 1
+        return seq
+    
+    def read(self, last_seq=0):
+        """Trả về (seq, view) mới nhất, hoặc (last_seq, None) nếu chưa có frame mới"""
+        seq, view = self.latest
+        if view is None or seq == last_seq:
+            return last_seq, None
+        return seq, view
+    
+    def is_current(self, seq):
+        """View của seq chưa bị writer ghi đè"""
+        return self.next_seq - seq < self.size
+
+class SyntheticCapture:
+    """Nguồn video tổng hợp thay cho cv2.VideoCapture, URL dạng "synthetic:640x480@30".
+    
+    Sinh frame theo đúng nhịp fps, có vạch di chuyển và số thứ tự để encoder
+    làm việc như với camera thật. Dùng để chạy thử và đo tải không cần camera.
+    Hậu tố ":<tỉ lệ>" (ví dụ "synthetic:640x480@30:0.2") cho vạch chỉ chạy
+    trong phần đó của mỗi chu kỳ 10 giây, còn lại đứng yên như hành lang vắng.
+    """
+    
+    CYCLE = 10.0
+    
+    def __init__(self, spec):
+        size, _, rate = spec.partition('@')
+        fps, _, motion = rate.partition(':')
+        width, _, height = (size or '640x480').partition('x')
+        self.width, self.height = int(width), int(height)
+        self.fps = float(fps or 30)
+        self.motion = float(motion or 1.0)
+        self.background = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        self.background[:] = np.linspace(40, 200, self.width, dtype=np.uint8)[None, :, None]
+        self.frame_count = 0
+        self.moving_frames = 0
+        self.next_frame_at = time.monotonic()
+        self.opened = True
+    
+    def isOpened(self):
+        return self.opened
+    
+    def set(self, prop, value):
+        return False
+    
+    def grab(self):
+        if not self.opened:
+            return False
+        # Chặn theo nhịp fps như camera thật
+        self.next_frame_at += 1 / self.fps
+        delay = self.next_frame_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            self.next_frame_at = time.monotonic()
+        self.frame_count += 1
+        if (self.frame_count / self.fps) % self.CYCLE < self.CYCLE * self.motion:
+            self.moving_frames += 1
+        return True
+    
+    def read(self, image=None):
+        if not self.grab():
+            return False, None
+        frame = image if image is not None and image.shape == self.background.shape else np.empty_like(self.background)
+        np.copyto(frame, self.background)
+        bar = self.width // 16
+        x = (self.moving_frames * 4) % (self.width - bar)
+        frame[:, x:x + bar] = 255
+        cv2.putText(frame, str(self.moving_frames), (10, self.height - 20), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (0, 0, 255), 2)
+        return True, frame
+    
+    def release(self):
+        self.opened = False
+
+def open_capture(url):
+    """Mở nguồn video: chỉ số webcam, URL stream, hoặc "synthetic:<WxH>@<fps>[:<tỉ lệ chuyển động>]" """
+    if url.startswith('synthetic:'):
+        return SyntheticCapture(url[len('synthetic:'):])
+    if url.isdigit():
+        return cv2.VideoCapture(int(url), cv2.CAP_DSHOW)
+    os.environ["OPENCV_FFMPEG_CAPTURE_OPTIONS"] = "rtsp_transport;udp"
+    return cv2.VideoCapture(url, cv2.CAP_FFMPEG)
+
 class CameraReader(threading.Thread):
     """Thread-safe camera reader để đọc frames từ camera/stream"""
     
-    def __init__(self, url, direction, loop, ready_event):
+    def __init__(self, url, direction):
         super().__init__(daemon=True)
         self.url = url
         self.direction = direction
-        self.latest_frame = None
+        # Frame BGR decode thẳng vào ring, reader lấy view không copy
+        self.ring = FrameRing(FRAME_RING_SIZE)
+        # (seq, buffer yuv420p, thời điểm capture) - dùng chung cho mọi video track
+        self.latest_video = (0, None, 0.0)
+        # Profile thu nhỏ đang có người xem: bounds -> {track_id: fps}
+        self.profiles = {}
+        self.profile_lock = threading.Lock()
+        # bounds -> kích thước thật, và kích thước -> (seq, i420, time) đã thu nhỏ
+        self.profile_sizes = {}
+        self.scaled_video = {}
         self.is_running = True
-        self.frame_lock = threading.Lock()
+        self.stopped = threading.Event()
         self.cap = None
-        self.loop = loop
-        self.ready_event = ready_event
+        # Được set khi camera mở thành công, dùng chung cho mọi người xem
+        self.ready_event = threading.Event()
+        # Consumer đang đăng ký: id -> fps mong muốn (0 = mọi frame)
+        self.consumers = {}
+        # Khoảng cách decode theo consumer nhanh nhất, 0 = decode mọi frame
+        self.decode_interval = 0
+        self._next_decode_at = 0.0
+        # Lần cuối có consumer xin frame; quá CAMERA_IDLE_AFTER thì chỉ grab()
+        self.last_request = time.monotonic()
+        # Phát hiện thay đổi cảnh: kênh Y thu nhỏ của frame trước, điểm của
+        # frame mới nhất và thời điểm hết coi là có chuyển động
+        self._scene_small = None
+        self.change_score = 0.0
+        self.change_scores = Histogram(CHANGE_BUCKETS)
+        self.motion_until = 0.0
         
-    def run(self):
-        """Main loop để đọc frames từ camera"""
-        retry_count = 0
-        max_retries = 5
+        # Thống kê decode
+        self.frames_decoded = 0
+        self.frames_grabbed = 0
+        self.frames_dropped = 0
+        self.decode_fps = 0.0
+        self.reconnects = 0
+        self._consumed_seq = 0
+        # Future của các consumer đang chờ frame mới (trên event loop của họ)
+        self.frame_waiters = []
+        self.waiters_lock = threading.Lock()
+        # Consumer là thread thường (client HTTP) chờ trên condition
+        self.frame_cond = threading.Condition()
+        self.sync_waiters = 0
+        # JPEG dùng chung cho mọi client MJPEG/latest.jpg
+        self.jpeg_cache = JpegCache(self)
+        self._fps_window_start = time.monotonic()
+        self._fps_window_count = 0
         
+    def run(self):
+        """Main loop để đọc frames từ camera.
+    
+        Khi không ai xin frame, chỉ grab() để stream không bị dồn trễ, bỏ qua
+        retrieve và chuyển màu; khi có consumer thì decode theo fps của
+        consumer nhanh nhất. Mất kết nối thì thử lại với backoff, không bỏ cuộc.
+        """
+        failures = 0
+    
         logger.info(f"[{self.direction}] Bắt đầu đọc camera từ: {self.url}")
-        
-        while self.is_running and retry_count < max_retries:
+    
+        while self.is_running:
             try:
                 # Thử kết nối camera
                 if self.cap is None or not self.cap.isOpened():
                     logger.info(f"[{self.direction}] Đang kết nối tới camera...")
-                    
-                    if self.url.isdigit():
-                        camera_index = int(self.url)
-                        self.cap = cv2.VideoCapture(camera_index, cv2.CAP_DSHOW)
+                    self.cap = open_capture(self.url)
+    
+                    if self.cap.isOpened():
+                        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+                        logger.info(f"[{self.direction}] Kết nối camera thành công!")
+    
+                        # Báo hiệu rằng camera đã sẵn sàng
+                        self.ready_event.set()
                     else:
-                        os.environ["OPENCV_FFMPEG_CAPTURE_OPTIONS"] = "rtsp_transport;udp"
-                        self.cap = cv2.VideoCapture(self.url, cv2.CAP_FFMPEG)
+                        logger.error(f"[{self.direction}] Không thể kết nối camera")
+                        failures += 1
+                        self._backoff(failures)
+                        continue
+    
+                if not self._should_decode():
+                    if self.cap.grab():
+                        failures = 0
+                        self._update_fps(decoded=False)
+                        continue
+                    ret, frame = False, None
+                else:
+                    # Đọc frame thẳng vào buffer của ring
+                    ret, frame = self.cap.read(self.ring.write_buffer())
+                if ret and frame is not None:
+                    failures = 0
+                    captured_at = time.monotonic()
+                    # Chuyển màu một lần cho mỗi frame nguồn
+                    i420 = bgr_to_i420(frame)
+                    self._update_scene(i420, captured_at)
+                    # Frame trước chưa được ai lấy -> tính là bị bỏ
+                    if self._consumed_seq < self.ring.next_seq - 1:
+                        self.frames_dropped += 1
+                    seq = self.ring.publish(frame)
+                    self.latest_video = (seq, i420, captured_at)
+                    if self.profiles:
+                        self._scale_profiles(frame, seq, i420, captured_at)
+                    self._update_fps()
+                    # Đánh thức consumer thay vì sleep cố định: cap.read() tự chặn
+                    # theo tốc độ camera
+                    self._notify_frame()
+                else:
+                    logger.warning(f"[{self.direction}] Không đọc được frame từ camera. Thử kết nối lại...")
+                    if self.cap:
+                        self.cap.release()
+                        self.cap = None
+                    self.reconnects += 1
+                    failures += 1
+                    self._backoff(failures)
+    
+            except Exception as e:
+                logger.error(f"[{self.direction}] Lỗi camera reader: {e}")
+                if self.cap:
+                    self.cap.release()
+                    self.cap = None
+                self.reconnects += 1
+                failures += 1
+                self._backoff(failures)
+    
+        self.cleanup()
+    
+    def _backoff(self, failures):
+        """Chờ trước lần kết nối lại thứ failures, dừng sớm nếu reader bị stop"""
+        delay = min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** min(failures - 1, 10))
+        # Lệch ngẫu nhiên để nhiều camera cùng mất mạng không kết nối lại cùng lúc
+        delay *= random.uniform(0.8, 1.2)
+        logger.info(f"[{self.direction}] Thử kết nối lại sau {delay:.1f}s (lần {failures})")
+        self.stopped.wait(delay)
+    
+    @property
+    def idle(self):
+        return time.monotonic() - self.last_request > CAMERA_IDLE_AFTER
+    
+    @property
+    def scene_static(self):
+        """Không có chuyển động hay quét thẻ trong SCENE_MOTION_HOLD giây gần nhất"""
+        return time.monotonic() >= self.motion_until
+    
+    def wake(self):
+        """Coi như có chuyển động (ví dụ vừa quét thẻ): video track quay lại full fps ngay"""
+        self.motion_until = max(self.motion_until, time.monotonic() + SCENE_MOTION_HOLD)
+    
+    def _update_scene(self, i420, captured_at):
+        """Điểm thay đổi cảnh: tỉ lệ điểm ảnh lệch quá SCENE_PIXEL_DELTA so với frame trước.
+        
+        Kênh Y của buffer I420 đã là ảnh xám nên chỉ cần thu nhỏ rồi absdiff
+        trên vài nghìn điểm ảnh. Lấy mẫu cách 4 điểm rồi INTER_AREA trung bình
+        2x2 (lọc bớt nhiễu): ~15us cho 640x480, so với ~170us nếu INTER_AREA
+        trên cả khung.
+        """
+        height, width = i420.shape[0] * 2 // 3, i420.shape[1]
+        size = (max(1, width // SCENE_DOWNSCALE), max(1, height // SCENE_DOWNSCALE))
+        step = SCENE_DOWNSCALE // 2
+        small = cv2.resize(i420[:height:step, ::step], size, interpolation=cv2.INTER_AREA)
+        previous, self._scene_small = self._scene_small, small
+        if previous is None or previous.shape != small.shape:
+            score = 1.0
+        else:
+            score = np.count_nonzero(cv2.absdiff(small, previous) > SCENE_PIXEL_DELTA) / small.size
+        self.change_score = score
+        self.change_scores.observe(score)
+        if score >= SCENE_CHANGE_THRESHOLD:
+            self.motion_until = captured_at + SCENE_MOTION_HOLD
+    
+    def _should_decode(self):
+        """Decode frame kế tiếp hay chỉ grab(): theo nhu cầu và fps của consumer nhanh nhất"""
+        now = time.monotonic()
+        if now - self.last_request > CAMERA_IDLE_AFTER:
+            return False
+        interval = self.decode_interval
+        if not interval:
+            return True
+        # Chừa 10% cho jitter của camera
+        if now < self._next_decode_at - interval * 0.1:
+            return False
+        # Tụt lại quá một khoảng thì bắt nhịp lại thay vì decode dồn
+        self._next_decode_at = max(self._next_decode_at, now - interval) + interval
+        return True
+    
+    def set_demand(self, consumer_id, fps=0):
+        """Đăng ký consumer cần frame với fps mong muốn (0 = mọi frame)"""
+        with self.profile_lock:
+            consumers = dict(self.consumers)
+            consumers[consumer_id] = fps
+            self._set_consumers(consumers)
+        self.last_request = time.monotonic()
+    
+    def clear_demand(self, consumer_id):
+        with self.profile_lock:
+            consumers = dict(self.consumers)
+            consumers.pop(consumer_id, None)
+            self._set_consumers(consumers)
+    
+    def _set_consumers(self, consumers):
+        rates = list(consumers.values())
+        # Không ai đăng ký fps (chỉ latest.jpg, ảnh sự kiện): decode mọi frame khi được xin
+        self.decode_interval = 0 if not rates or 0 in rates else 1 / max(rates)
+        self.consumers = consumers
+    
+    def _update_fps(self, decoded=True):
+        """Cập nhật số frame đã decode/grab và fps decode theo cửa sổ 1 giây"""
+        if decoded:
+            self.frames_decoded += 1
+            self._fps_window_count += 1
+        else:
+            self.frames_grabbed += 1
+        now = time.monotonic()
+        elapsed = now - self._fps_window_start
+        if elapsed >= 1.0:
+            self.decode_fps = self._fps_window_count / elapsed
+            self._fps_window_start = now
+            self._fps_window_count = 0
+    
+    def get_frame(self):
+        """Lấy frame BGR mới nhất (view read-only, không copy)"""
+        return self.read_frame()[1]
+    
+    def read_frame(self, last_seq=0):
+        """Lấy frame BGR mới hơn last_seq dưới dạng (seq, view).
+
+        View chỉ hợp lệ trong vài frame, xem FrameRing.is_current().
+        """
+        self.last_request = time.monotonic()
+        seq, view = self.ring.read(last_seq)
+        if view is not None:
+            self._consumed_seq = seq
+        return seq, view
+    
+    def get_video_frame(self, last_seq=0, bounds=None):
+        """Lấy frame yuv420p mới hơn last_seq.
+
+        Trả về (seq, i420, frame_time) hoặc (last_seq, None, None) nếu chưa
+        có frame mới. Buffer i420 là read-only, mỗi frame một buffer riêng
+        nên giữ lâu cũng an toàn. Với bounds đã đăng ký qua add_profile(),
+        trả về bản thu nhỏ dùng chung.
+        """
+        self.last_request = time.monotonic()
+        if bounds:
+            size = self.profile_sizes.get(bounds)
+            entry = self.scaled_video.get(size) if size else None
+            seq, i420, frame_time = entry or (0, None, 0.0)
+        else:
+            seq, i420, frame_time = self.latest_video
+        if i420 is None or seq == last_seq:
+            return last_seq, None, None
+        self._consumed_seq = seq
+        return seq, i420, frame_time
+    
+    def add_profile(self, track_id, bounds, fps=0):
+        """Đăng ký một người xem cần frame thu nhỏ theo bounds=(max_width, max_height)"""
+        with self.profile_lock:
+            profiles = {key: dict(tracks) for key, tracks in self.profiles.items()}
+            profiles.setdefault(bounds, {})[track_id] = fps
+            self.profiles = profiles
+    
+    def remove_profile(self, track_id, bounds):
+        with self.profile_lock:
+            profiles = {key: dict(tracks) for key, tracks in self.profiles.items()}
+            tracks = profiles.get(bounds, {})
+            tracks.pop(track_id, None)
+            if not tracks:
+                profiles.pop(bounds, None)
+            self.profiles = profiles
+    
+    def _scale_profiles(self, frame, seq, i420, captured_at):
+        """Thu nhỏ frame một lần cho mỗi kích thước đang được xem"""
+        height, width = frame.shape[:2]
+        profile_sizes = {}
+        size_fps = {}
+        for bounds, tracks in self.profiles.items():
+            size = scaled_size(width, height, *bounds)
+            profile_sizes[bounds] = size
+            size_fps.setdefault(size, []).extend(tracks.values())
+        
+        scaled_video = {}
+        for size, fps_values in size_fps.items():
+            # fps = 0 nghĩa là không giới hạn
+            fps = 0 if 0 in fps_values else max(fps_values)
+            if size == (width - width % 2, height - height % 2):
+                scaled_video[size] = (seq, i420, captured_at)
+                continue
+            previous = self.scaled_video.get(size)
+            # Bỏ qua frame nếu mọi người xem kích thước này đều cần fps thấp hơn
+            if fps and previous and captured_at - previous[2] < 0.9 / fps:
+                scaled_video[size] = previous
+                continue
+            small = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+            scaled_video[size] = (seq, bgr_to_i420(small), captured_at)
+        
+        self.scaled_video = scaled_video
+        self.profile_sizes = profile_sizes
+    
+    def _notify_frame(self):
+        """Đánh thức mọi consumer đang chờ, một lần call_soon_threadsafe cho mỗi loop"""
+        if self.sync_waiters:
+            with self.frame_cond:
+                self.frame_cond.notify_all()
+        with self.waiters_lock:
+            if not self.frame_waiters:
+                return
+            waiters, self.frame_waiters = self.frame_waiters, []
+        by_loop = {}
+        for future in waiters:
+            by_loop.setdefault(future.get_loop(), []).append(future)
+        for loop, futures in by_loop.items():
+            try:
+                loop.call_soon_threadsafe(wake_futures, futures)
+            except RuntimeError:
+                # Loop đã đóng
+                pass
+    
+    async def wait_video_frame(self, last_seq=0, timeout=None, bounds=None):
+        """Chờ tới khi có frame yuv420p mới hơn last_seq (hoặc hết timeout).
+
+        Trả về giống get_video_frame().
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            result = self.get_video_frame(last_seq, bounds)
+            if result[1] is not None or not self.is_running:
+                return result
+            future = loop.create_future()
+            with self.waiters_lock:
+                self.frame_waiters.append(future)
+            # Kiểm tra lại sau khi đăng ký để không lỡ frame vừa publish
+            result = self.get_video_frame(last_seq, bounds)
+            if result[1] is not None:
+                return result
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                return result
+            try:
+                await asyncio.wait_for(future, remaining)
+            except asyncio.TimeoutError:
+                return self.get_video_frame(last_seq, bounds)
+    
+    def wait_video_frame_blocking(self, last_seq=0, timeout=None, bounds=None):
+        """Bản chặn của wait_video_frame() cho consumer chạy trên thread thường"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.frame_cond:
+            self.sync_waiters += 1
+            try:
+                while True:
+                    result = self.get_video_frame(last_seq, bounds)
+                    if result[1] is not None or not self.is_running:
+                        return result
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return result
+                    self.frame_cond.wait(remaining)
+            finally:
+                self.sync_waiters -= 1
+    
+    def cleanup(self):
+        """Dọn dẹp resources"""
+        self.is_running = False
+        self.stopped.set()
+        self._notify_frame()
+        if self.cap:
+            self.cap.release()
+            self.cap = None
+        logger.info(f"[{self.direction}] Camera reader đã dọn dẹp")
+    
+    def stop(self):
+        """Dừng camera reader"""
+        self.cleanup()
+
+# Hướng tạm của reader chỉ có client HTTP xem; WebRTC với hướng thật sẽ ghi đè
+HTTP_DIRECTION = 'http'
+
+class CaptureHub:
+    """Quản lý CameraReader dùng chung theo URL.
+
+    Mỗi nguồn (URL) chỉ có một CameraReader/VideoCapture, dù có bao nhiêu
+    người xem. Đếm tham chiếu để dừng reader khi người xem cuối cùng rời đi.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.readers = {}
+        self.subscribers = {}
+    
+    def acquire(self, url, direction=None):
+        """Lấy (hoặc tạo mới) reader cho URL và tăng số người xem.
+
+        direction=None (client HTTP) không đổi hướng của reader đã có.
+        """
+        with self.lock:
+            reader = self.readers.get(url)
+            if reader is None or not reader.is_alive():
+                reader = CameraReader(url, direction or HTTP_DIRECTION)
+                self.readers[url] = reader
+                self.subscribers[url] = 0
+                reader.start()
+                logger.info(f"[{reader.direction}] Tạo CameraReader mới cho: {url}")
+            elif direction and reader.direction == HTTP_DIRECTION:
+                reader.direction = direction
+            self.subscribers[url] += 1
+            return reader
+    
+    def release(self, reader):
+        """Giảm số người xem, dừng reader khi không còn ai xem"""
+        with self.lock:
+            url = reader.url
+            if self.readers.get(url) is not reader:
+                # Reader cũ đã bị thay thế (ví dụ sau khi chết), chỉ cần dừng nó
+                reader.stop()
+                return
+            self.subscribers[url] -= 1
+            if self.subscribers[url] <= 0:
+                self.readers.pop(url)
+                self.subscribers.pop(url)
+                reader.stop()
+                logger.info(f"[{reader.direction}] Không còn người xem, đã dừng CameraReader: {url}")
+    
+    def reader_for(self, url):
+        """Reader đang chạy và đã mở camera của URL, None nếu không có"""
+        reader = self.readers.get(url)
+        if reader is not None and reader.is_running and reader.ready_event.is_set():
+            return reader
+        return None
+    
+    def wake(self, url):
+        """Báo có người ở cửa (quét thẻ) cho camera của cửa đó, nếu đang chạy"""
+        reader = self.readers.get(url) if url else None
+        if reader is not None:
+            reader.wake()
+    
+    def latest_frame(self, url, max_age=2.0):
+        """(reader, seq, i420) mới nhất của camera URL nếu đang chạy, None nếu không có"""
+        reader = self.readers.get(url)
+        if reader is None:
+            return None
+        seq, i420, captured_at = reader.latest_video
+        if i420 is not None and time.monotonic() - captured_at <= max_age:
+            return reader, seq, i420
+        return None
+    
+    def get_stats(self):
+        """Thống kê theo từng nguồn camera"""
+        with self.lock:
+            return [{
+                'url': url,
+                'direction': reader.direction,
+                'subscribers': self.subscribers[url],
+                'running': reader.is_alive() and reader.is_running,
+                'ready': reader.ready_event.is_set(),
+                'decode_fps': round(reader.decode_fps, 2),
+                'target_fps': round(1 / reader.decode_interval, 2) if reader.decode_interval else 0,
+                'idle': reader.idle,
+                'change_score': round(reader.change_score, 4),
+                'static': reader.scene_static,
+                'frames_decoded': reader.frames_decoded,
+                'frames_grabbed': reader.frames_grabbed,
+                'frames_dropped': reader.frames_dropped,
+                'reconnects': reader.reconnects,
+                'http': reader.jpeg_cache.get_stats()
+            } for url, reader in self.readers.items()]
+
+    def collect_metrics(self, out):
+        with self.lock:
+            readers = [(url, reader, self.subscribers[url]) for url, reader in self.readers.items()]
+        now = time.monotonic()
+        families = (
+            ('rfid_camera_subscribers', 'gauge', 'Số người xem đang dùng nguồn camera', lambda reader, subscribers: subscribers),
+            ('rfid_camera_decode_fps', 'gauge', 'Số frame decode mỗi giây', lambda reader, subscribers: reader.decode_fps),
+            ('rfid_camera_frames_decoded_total', 'counter', 'Tổng số frame đã decode', lambda reader, subscribers: reader.frames_decoded),
+            ('rfid_camera_frames_grabbed_total', 'counter', 'Frame chỉ grab() vì không ai cần',
+             lambda reader, subscribers: reader.frames_grabbed),
+            ('rfid_camera_idle', 'gauge', '1 khi không consumer nào xin frame gần đây', lambda reader, subscribers: int(reader.idle)),
+            ('rfid_camera_scene_static', 'gauge', '1 khi cảnh đứng yên, video track chỉ gửi frame giữ kết nối',
+             lambda reader, subscribers: int(reader.scene_static)),
+            ('rfid_camera_frames_dropped_total', 'counter', 'Frame bị thay trước khi có người lấy', lambda reader, subscribers: reader.frames_dropped),
+            ('rfid_camera_reconnects_total', 'counter', 'Số lần mất kết nối camera', lambda reader, subscribers: reader.reconnects),
+            ('rfid_camera_http_clients', 'gauge', 'Số client MJPEG đang xem', lambda reader, subscribers: reader.jpeg_cache.clients),
+            ('rfid_camera_jpeg_encodes_total', 'counter', 'Số lần mã hoá JPEG cho client HTTP',
+             lambda reader, subscribers: reader.jpeg_cache.encodes),
+            ('rfid_camera_jpeg_served_total', 'counter', 'Số ảnh JPEG đã gửi cho client HTTP',
+             lambda reader, subscribers: reader.jpeg_cache.served),
+            ('rfid_camera_frame_age_seconds', 'gauge', 'Tuổi của frame mới nhất',
+             lambda reader, subscribers: now - reader.latest_video[2] if reader.latest_video[1] is not None else float('nan')),
+        )
+        for name, kind, help_text, value in families:
+            out.family(name, kind, help_text)
+            for url, reader, subscribers in readers:
+                out.sample(name, value(reader, subscribers), {'source': redact_url(url), 'direction': reader.direction})
+        out.family('rfid_camera_change_score', 'histogram', 'Tỉ lệ điểm ảnh thay đổi giữa hai frame decode liên tiếp')
+        for url, reader, subscribers in readers:
+            out.histogram('rfid_camera_change_score', reader.change_scores, {'source': redact_url(url), 'direction': reader.direction})
+
+class JpegCache:
+    """JPEG của frame mới nhất theo (chất lượng, bounds), dùng chung cho mọi client HTTP.
+    
+    Client đầu tiên cần một frame sẽ mã hoá, các client khác cùng mức chất
+    lượng chờ trên lock rồi nhận lại đúng bytes đó: mỗi frame nguồn được mã
+    hoá tối đa một lần cho mỗi mức, dù có bao nhiêu người xem.
+    """
+    
+    def __init__(self, reader):
+        self.reader = reader
+        # (quality, bounds) -> (seq, bytes JPEG)
+        self.entries = {}
+        self.locks = {}
+        self.clients = 0
+        self.encodes = 0
+        self.served = 0
+    
+    def get(self, last_seq=0, quality=JPEG_DEFAULT_QUALITY, bounds=None, timeout=None):
+        """(seq, bytes) của frame mới hơn last_seq, (last_seq, None) nếu hết timeout"""
+        seq, i420, _ = self.reader.wait_video_frame_blocking(last_seq, timeout, bounds)
+        if i420 is None:
+            return last_seq, None
+        key = (quality, bounds)
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < seq:
+            with self.locks.setdefault(key, threading.Lock()):
+                entry = self.entries.get(key)
+                # Client khác có thể đã mã hoá frame này (hoặc mới hơn) trong lúc chờ lock
+                if entry is None or entry[0] < seq:
+                    bgr = cv2.cvtColor(i420, cv2.COLOR_YUV2BGR_I420)
+                    ok, jpeg = cv2.imencode('.jpg', bgr, [cv2.IMWRITE_JPEG_QUALITY, quality])
+                    if not ok:
+                        return last_seq, None
+                    entry = (seq, jpeg.tobytes())
+                    self.entries[key] = entry
+                    self.encodes += 1
+        self.served += 1
+        return entry
+    
+    def get_stats(self):
+        return {
+            'clients': self.clients,
+            'encodes': self.encodes,
+            'served': self.served,
+            'levels': len(self.entries)
+        }
+
+class MjpegStream:
+    """Body multipart/x-mixed-replace cho một client MJPEG.
+    
+    Mỗi vòng lấy frame mới nhất từ JpegCache chứ không xếp hàng: client chậm
+    bị chặn ở socket và tự bỏ qua các frame ở giữa thay vì làm phình bộ nhớ.
+    """
+    
+    BOUNDARY = 'frame'
+    # Gửi lại ảnh cũ khi camera im lặng để phát hiện client đã ngắt
+    KEEPALIVE = 5.0
+    
+    def __init__(self, reader, quality=JPEG_DEFAULT_QUALITY, bounds=None, max_fps=0):
+        self.reader = reader
+        self.quality = quality
+        self.bounds = bounds
+        self.interval = 1 / max_fps if max_fps else 0
+        self.closed = False
+        if bounds:
+            reader.add_profile(id(self), bounds, max_fps)
+        reader.set_demand(id(self), max_fps)
+        reader.jpeg_cache.clients += 1
+    
+    def part(self, jpeg):
+        header = f'--{self.BOUNDARY}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(jpeg)}\r\n\r\n'
+        return header.encode() + jpeg + b'\r\n'
+    
+    def __iter__(self):
+        cache = self.reader.jpeg_cache
+        last_seq, jpeg = 0, None
+        next_at = time.monotonic()
+        while not self.closed and self.reader.is_running:
+            seq, fresh = run_blocking(cache.get, last_seq, self.quality, self.bounds, self.KEEPALIVE)
+            if fresh is None and jpeg is None:
+                continue
+            if fresh is not None:
+                last_seq, jpeg = seq, fresh
+            yield self.part(jpeg)
+            if self.interval:
+                next_at += self.interval
+                delay = next_at - time.monotonic()
+                if delay > 0:
+                    socketio.sleep(delay)
+                else:
+                    next_at = time.monotonic()
+    
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.bounds:
+            self.reader.remove_profile(id(self), self.bounds)
+        self.reader.clear_demand(id(self))
+        self.reader.jpeg_cache.clients -= 1
+
+class OpenCVVideoStreamTrack(MediaStreamTrack):
+    """Custom video track cho aiortc từ OpenCV"""
+    
+    kind = "video"
+    
+    # Thời gian chờ frame mới trước khi gửi "No Signal"
+    NO_SIGNAL_TIMEOUT = 1.0
+    # Cảnh đứng yên: chỉ gửi một frame giữ kết nối mỗi khoảng này
+    STATIC_INTERVAL = 1.0
+    # Khoảng cách frame dùng để đánh giá encoder khi không giới hạn fps
+    NOMINAL_INTERVAL = 1 / 30
+    # fps thấp nhất khi encoder bị quá tải
+    MAX_INTERVAL = 1.0
+    
+    def __init__(self, camera_reader, max_width=0, max_height=0, max_fps=0):
+        super().__init__()
+        self.camera_reader = camera_reader
+        self.last_seq = 0
+        self.last_pts = -1
+        
+        # Profile người xem yêu cầu trong offer
+        self.bounds = (max_width, max_height) if (max_width or max_height) else None
+        self.frame_interval = 1 / max_fps if max_fps else 0
+        if self.bounds:
+            camera_reader.add_profile(id(self), self.bounds, max_fps)
+        camera_reader.set_demand(id(self), max_fps)
+        
+        # Điều tiết theo tốc độ encoder
+        self.interval = self.frame_interval
+        self.encode_time = 0.0
+        self.last_return = None
+        self.last_sent = 0.0
+        self.frames_sent = 0
+        self.frames_skipped = 0
+        self.frames_static = 0
+        self.recv_time = Histogram(RECV_BUCKETS)
+    
+    def _adapt_interval(self, busy):
+        """Giảm fps khi encoder không theo kịp, tăng dần lại khi encoder rảnh.
+
+        busy là thời gian từ lúc trả frame trước tới lần gọi recv() này,
+        tức là thời gian encode + gửi của frame trước.
+        """
+        self.encode_time = busy if not self.encode_time else 0.8 * self.encode_time + 0.2 * busy
+        budget = self.interval or self.NOMINAL_INTERVAL
+        if self.encode_time > 0.8 * budget:
+            self.interval = min(budget * 1.5, self.MAX_INTERVAL)
+        elif self.interval > self.frame_interval and self.encode_time < 0.5 * budget:
+            interval = budget * 0.9
+            if interval <= max(self.frame_interval, self.NOMINAL_INTERVAL):
+                interval = self.frame_interval
+            self.interval = interval
+    
+    async def recv(self):
+        """Nhận frame tiếp theo cho WebRTC stream"""
+        now = started = time.monotonic()
+        if self.last_return is not None:
+            self._adapt_interval(now - self.last_return)
+        
+        # Giữ fps không vượt quá yêu cầu của người xem / khả năng encoder
+        wait = self.last_sent + self.interval - now
+        if wait > 0:
+            await asyncio.sleep(wait)
+        
+        # Chỉ gửi frame có seq mới, không gửi lại frame đã gửi
+        while True:
+            seq, i420, frame_time = await self.camera_reader.wait_video_frame(
+                self.last_seq, self.NO_SIGNAL_TIMEOUT, self.bounds)
+            # Cảnh đứng yên: bỏ qua frame không cần encode, xét lại mỗi frame
+            # để chuyển động hay quét thẻ đưa track về full fps ngay
+            if (i420 is None or not self.camera_reader.scene_static
+                    or time.monotonic() - self.last_sent >= self.STATIC_INTERVAL):
+                break
+            self.last_seq = seq
+            self.frames_static += 1
+        
+        if i420 is None:
+            i420, frame_time = NO_SIGNAL_I420, time.monotonic()
+        else:
+            if self.last_seq:
+                self.frames_skipped += max(0, seq - self.last_seq - 1)
+            self.last_seq = seq
+            self.frames_sent += 1
+        
+        # Bọc buffer dùng chung, không copy. Mỗi track có VideoFrame riêng
+        # vì encoder ghi đè pts/time_base/pict_type trên frame.
+        av_frame = av.VideoFrame.from_numpy_buffer(i420, format="yuv420p")
+        self.last_pts = max(video_pts(frame_time), self.last_pts + 1)
+        av_frame.pts = self.last_pts
+        av_frame.time_base = VIDEO_TIME_BASE
+        
+        self.last_sent = self.last_return = time.monotonic()
+        self.recv_time.observe(self.last_return - started)
+        return av_frame
+    
+    def stop(self):
+        super().stop()
+        if self.bounds:
+            self.camera_reader.remove_profile(id(self), self.bounds)
+        self.camera_reader.clear_demand(id(self))
+
+class AsyncLoopThread:
+    """Một event loop asyncio sống suốt vòng đời process.
+
+    Mọi RTCPeerConnection được tạo và đóng trên loop này, thay vì mỗi offer
+    một thread và một loop riêng bị đóng ngay sau khi trả answer.
+    """
+    
+    def __init__(self, name='webrtc-loop'):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.start_lock = threading.Lock()
+    
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+    
+    def start(self):
+        with self.start_lock:
+            if not self.thread.is_alive():
+                self.thread.start()
+    
+    def submit(self, coro):
+        """Chạy coroutine trên loop từ thread bất kỳ, trả về concurrent.futures.Future"""
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+# --- SQLite: pool kết nối và ghi log theo lô ---
+# Pragma áp dụng cho mọi kết nối: WAL cho phép đọc song song với ghi,
+# synchronous=NORMAL chỉ fsync ở checkpoint thay vì mỗi commit
+DB_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-16000',
+    'PRAGMA busy_timeout=5000',
+)
+
+def connect_db(db_path):
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    for pragma in DB_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+class ConnectionPool:
+    """Pool kết nối SQLite dùng lại giữa các thread (Flask, serial, writer)"""
+    
+    def __init__(self, db_path, size=4):
+        self.db_path = db_path
+        self.idle = queue.LifoQueue(maxsize=size)
+    
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            conn = connect_db(self.db_path)
+        try:
+            yield conn
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            try:
+                self.idle.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+    
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+# Gán ảnh chụp cho một access log đã đưa vào writer trước đó
+SnapshotUpdate = collections.namedtuple('SnapshotUpdate', 'log_id digest')
+
+# Mã lỗi gốc của SQLite cho DB đang bị khoá/bận (sqlite3.SQLITE_BUSY/LOCKED từ Python 3.11)
+SQLITE_BUSY = 5
+SQLITE_LOCKED = 6
+
+def is_sqlite_busy(error):
+    """Lỗi tạm thời do DB bị khoá/bận, thử lại là được (kể cả mã mở rộng như SQLITE_BUSY_SNAPSHOT)"""
+    if not isinstance(error, sqlite3.OperationalError):
+        return False
+    code = getattr(error, 'sqlite_errorcode', None)
+    if code is None:
+        # Python cũ không có mã lỗi, dựa vào thông điệp
+        return 'locked' in str(error) or 'busy' in str(error)
+    return code & 0xff in (SQLITE_BUSY, SQLITE_LOCKED)
+
+class AccessLogWriter(threading.Thread):
+    """Ghi access_log trong thread nền, gom nhiều dòng vào một commit.
+    
+    Hàng đợi có giới hạn: khi đầy, submit() chặn (backpressure) thay vì làm
+    mất log. Lô gặp DB bị khoá/bận lâu hơn busy_timeout được giữ lại và thử
+    lại với backoff cho tới khi ghi được; mọi lỗi khác (dữ liệu, schema, đĩa)
+    không tự hết nên ghi từng dòng một để chỉ dòng hỏng bị bỏ (được log đầy
+    đủ và đếm ở rows_failed), cửa vẫn tiếp tục trả lời. stop() ghi hết hàng
+    đợi trước khi dừng, được gọi qua atexit.
+    """
+    
+    # Backoff giữa các lần thử lại một lô: 0.1, 0.2, 0.4... tối đa 2 giây
+    RETRY_BASE_DELAY = 0.1
+    RETRY_MAX_DELAY = 2.0
+    
+    def __init__(self, pool, max_queue=10000, batch_size=500, flush_interval=0.05, on_commit=None, max_retries=5):
+        super().__init__(name='access-log-writer', daemon=True)
+        self.pool = pool
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_commit = on_commit
+        self.max_retries = max_retries
+        self.is_running = True
+        
+        # Metrics
+        self.rows_written = 0
+        self.commits = 0
+        self.blocked_submits = 0
+        self.max_queue_depth = 0
+        self.last_commit_ms = 0.0
+        self.max_commit_ms = 0.0
+        self.total_commit_ms = 0.0
+        self.commit_latency = Histogram()
+        self.write_retries = 0
+        self.rows_failed = 0
+    
+    def submit(self, row):
+        """Đưa một dòng (id, timestamp, direction, uid, status, door, ts, snapshot)
+        hoặc một SnapshotUpdate vào hàng đợi ghi"""
+        try:
+            self.queue.put_nowait(row)
+        except queue.Full:
+            self.blocked_submits += 1
+            self.queue.put(row)
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+    
+    def run(self):
+        while self.is_running or not self.queue.empty():
+            try:
+                row = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            batch = [row]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write_batch(batch)
+    
+    def _commit(self, rows, updates):
+        with self.pool.connection() as conn:
+            try:
+                if rows:
+                    conn.executemany('INSERT INTO access_log (id, timestamp, direction, card_uid, status, door, ts, snapshot) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                if updates:
+                    conn.executemany('UPDATE access_log SET snapshot = ? WHERE id = ?', [(update.digest, update.log_id) for update in updates])
+                conn.commit()
+            except Exception:
+                # Không để transaction dở dang trên kết nối trả về pool
+                conn.rollback()
+                raise
+    
+    def _write_batch(self, batch):
+        # Hàng đợi FIFO nên SnapshotUpdate luôn đến sau dòng mà nó cập nhật
+        rows = [item for item in batch if not isinstance(item, SnapshotUpdate)]
+        updates = [item for item in batch if isinstance(item, SnapshotUpdate)]
+        attempt = 0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    self._commit(rows, updates)
+                    break
+                except Exception as e:
+                    # Lỗi không tự hết (trùng id, mất bảng, đĩa đầy...) hoặc đang dừng mà
+                    # hết lượt thử: ghi từng dòng để chỉ bỏ dòng hỏng
+                    if not is_sqlite_busy(e) or (not self.is_running and attempt >= self.max_retries):
+                        logger.error(f"Lỗi ghi {len(batch)} access log: {e}, chuyển sang ghi từng dòng")
+                        rows, updates = self._write_each(rows, updates)
+                        break
+                    # DB bị khoá/bận: giữ lô và thử lại, hàng đợi đầy thì submit() chặn
+                    self.write_retries += 1
+                    delay = min(self.RETRY_MAX_DELAY, self.RETRY_BASE_DELAY * 2 ** min(attempt, 10))
+                    attempt += 1
+                    logger.warning(f"Lỗi ghi {len(batch)} access log: {e}, thử lại sau {delay:.1f}s (lần {attempt})")
+                    time.sleep(delay)
+        finally:
+            for _ in batch:
+                self.queue.task_done()
+        elapsed = time.perf_counter() - start
+        self.commit_latency.observe(elapsed)
+        elapsed_ms = elapsed * 1000
+        self.commits += 1
+        self.rows_written += len(rows)
+        self.last_commit_ms = elapsed_ms
+        self.max_commit_ms = max(self.max_commit_ms, elapsed_ms)
+        self.total_commit_ms += elapsed_ms
+        if self.on_commit:
+            try:
+                self.on_commit(rows, updates)
+            except Exception as e:
+                logger.error(f"Lỗi callback sau commit access log: {e}")
+    
+    def _write_each(self, rows, updates):
+        """Ghi từng dòng một transaction, trả về (rows, updates) đã ghi được"""
+        written_rows, written_updates = [], []
+        for row in rows:
+            try:
+                self._commit([row], ())
+                written_rows.append(row)
+            except Exception as e:
+                self.rows_failed += 1
+                logger.error(f"Bỏ access log không ghi được {tuple(row)}: {e}")
+        for update in updates:
+            try:
+                self._commit((), [update])
+                written_updates.append(update)
+            except Exception as e:
+                self.rows_failed += 1
+                logger.error(f"Bỏ cập nhật ảnh của access log {update.log_id}: {e}")
+        return written_rows, written_updates
+    
+    def flush(self):
+        """Chờ tới khi mọi dòng đã submit được ghi xong"""
+        self.queue.join()
+    
+    def stop(self):
+        """Dừng writer sau khi đã ghi hết hàng đợi"""
+        self.is_running = False
+        if self.is_alive():
+            self.join()
+    
+    def get_stats(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'max_queue_depth': self.max_queue_depth,
+            'queue_capacity': self.queue.maxsize,
+            'blocked_submits': self.blocked_submits,
+            'rows_written': self.rows_written,
+            'write_retries': self.write_retries,
+            'rows_failed': self.rows_failed,
+            'commits': self.commits,
+            'rows_per_commit': round(self.rows_written / self.commits, 2) if self.commits else 0,
+            'last_commit_ms': round(self.last_commit_ms, 3),
+            'max_commit_ms': round(self.max_commit_ms, 3),
+            'avg_commit_ms': round(self.total_commit_ms / self.commits, 3) if self.commits else 0
+        }
+
+LOG_COLUMNS = ('id', 'timestamp', 'direction', 'card_uid', 'status', 'door', 'ts', 'snapshot')
+LOG_SELECT = 'SELECT id, timestamp, direction, card_uid, status, door, ts, snapshot FROM access_log'
+
+# Index cho tìm kiếm/báo cáo; rowid (id) nằm sẵn cuối mỗi index nên
+# ORDER BY ts, id dùng được index luôn
+ACCESS_LOG_INDEXES = (
+    'CREATE INDEX IF NOT EXISTS idx_access_log_ts ON access_log (ts)',
+    'CREATE INDEX IF NOT EXISTS idx_access_log_uid_ts ON access_log (card_uid, ts)',
+    'CREATE INDEX IF NOT EXISTS idx_access_log_door_ts ON access_log (door, ts)',
+    'CREATE INDEX IF NOT EXISTS idx_access_log_status_ts ON access_log (status, ts)',
+)
+
+def migrate_authorized_cards(conn):
+    """Nâng cấp bảng authorized_cards của DB cũ: thêm cột nhóm và lịch riêng của thẻ"""
+    cursor = conn.cursor()
+    columns = {row[1] for row in cursor.execute('PRAGMA table_info(authorized_cards)')}
+    if 'group_name' not in columns:
+        cursor.execute('ALTER TABLE authorized_cards ADD COLUMN group_name TEXT')
+    if 'schedule' not in columns:
+        cursor.execute('ALTER TABLE authorized_cards ADD COLUMN schedule TEXT')
+    conn.commit()
+
+def migrate_access_log(conn):
+    """Nâng cấp bảng access_log của DB cũ: thêm cột door, ts (epoch), snapshot và index"""
+    cursor = conn.cursor()
+    columns = {row[1] for row in cursor.execute('PRAGMA table_info(access_log)')}
+    if 'door' not in columns:
+        # DB trước khi hỗ trợ nhiều controller
+        cursor.execute('ALTER TABLE access_log ADD COLUMN door TEXT')
+    if 'ts' not in columns:
+        # timestamp TEXT được ghi theo giờ máy: 'utc' đổi giờ địa phương sang epoch
+        logger.info("Đang chuyển timestamp của access_log sang epoch...")
+        cursor.execute('ALTER TABLE access_log ADD COLUMN ts INTEGER')
+        cursor.execute("UPDATE access_log SET ts = CAST(strftime('%s', timestamp, 'utc') AS INTEGER)")
+    if 'snapshot' not in columns:
+        # Mã SHA-256 của ảnh chụp lúc quét thẻ (SnapshotStore)
+        cursor.execute('ALTER TABLE access_log ADD COLUMN snapshot TEXT')
+    for statement in ACCESS_LOG_INDEXES:
+        cursor.execute(statement)
+    conn.commit()
+
+# Giá trị status trong DB, cho phép lọc bằng tên tiếng Anh
+STATUS_ALIASES = {'ALLOW': 'Cho phép', 'DENY': 'Từ chối'}
+LOG_GROUPS = ('hour', 'day', 'door', 'direction', 'status', 'card_uid')
+
+def parse_log_time(value):
+    """Epoch (số) hoặc thời gian ISO theo giờ máy -> epoch giây"""
+    if value is None or value == '':
+        return None
+    if value.isdigit():
+        return int(value)
+    return int(datetime.fromisoformat(value).timestamp())
+
+def parse_log_filters(args):
+    """Đọc bộ lọc access log từ query string, ValueError nếu không hợp lệ"""
+    status = args.get('status')
+    filters = {
+        'card_uid': (args.get('uid') or '').strip().upper() or None,
+        'direction': (args.get('direction') or '').strip().upper() or None,
+        'status': STATUS_ALIASES.get((status or '').upper(), status) or None,
+        'door': args.get('door') or None,
+        'from': parse_log_time(args.get('from')),
+        'to': parse_log_time(args.get('to')),
+    }
+    return filters
+
+def parse_log_cursor(cursor):
+    """(ts, id) từ cursor "ts:id" của search_logs, ValueError nếu không hợp lệ"""
+    cursor_ts, cursor_id = (int(part) for part in cursor.split(':'))
+    return cursor_ts, cursor_id
+
+def build_log_where(filters):
+    """Tạo mệnh đề WHERE và tham số từ bộ lọc; khoảng thời gian là [from, to)"""
+    clauses, params = [], []
+    for column in ('card_uid', 'direction', 'status', 'door'):
+        if filters.get(column) is not None:
+            clauses.append(f'{column} = ?')
+            params.append(filters[column])
+    if filters.get('from') is not None:
+        clauses.append('ts >= ?')
+        params.append(filters['from'])
+    if filters.get('to') is not None:
+        clauses.append('ts < ?')
+        params.append(filters['to'])
+    return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+def local_time_expression(first, last):
+    """Biểu thức SQL đổi ts sang giây "giờ máy" cho từng dòng, hợp lệ trong [first, last].
+    
+    Tìm các lần đổi giờ (mùa hè) trong khoảng bằng cách lấy mẫu mỗi ngày rồi
+    chia đôi tới từng giây, sau đó cộng offset theo đoạn bằng CASE: vẫn là
+    phép cộng/chia nguyên nên nhanh hơn nhiều so với strftime(..., 'localtime')
+    trên mỗi dòng.
+    """
+    def offset_at(ts):
+        return time.localtime(ts).tm_gmtoff
+    
+    segments = [(first, offset_at(first))]
+    previous = first
+    while previous < last:
+        current = min(previous + 86400, last)
+        if offset_at(current) != segments[-1][1]:
+            low, high = previous, current
+            while high - low > 1:
+                middle = (low + high) // 2
+                if offset_at(middle) == segments[-1][1]:
+                    low = middle
+                else:
+                    high = middle
+            segments.append((high, offset_at(high)))
+        previous = current
+    if len(segments) == 1:
+        return f'(ts + {segments[0][1]})'
+    cases = ' '.join(f'WHEN ts < {start} THEN {offset}' for (_, offset), (start, _) in zip(segments, segments[1:]))
+    return f'(ts + CASE {cases} ELSE {segments[-1][1]} END)'
+
+class RecentLogBuffer:
+    """Ring các access log mới nhất đã commit, tăng dần theo id.
+
+    Phục vụ /api/logs và việc client bắt kịp sau khi kết nối lại mà không
+    cần truy vấn DB.
+    """
+    
+    def __init__(self, capacity=1000):
+        self.entries = collections.deque(maxlen=capacity)
+        self.lock = threading.Lock()
+    
+    def extend(self, entries):
+        with self.lock:
+            self.entries.extend(entries)
+    
+    def update(self, log_id, **fields):
+        """Sửa một dòng còn trong ring (entry được thay thế, không sửa tại chỗ)"""
+        with self.lock:
+            for index in range(len(self.entries) - 1, -1, -1):
+                entry = self.entries[index]
+                if entry['id'] == log_id:
+                    self.entries[index] = dict(entry, **fields)
+                    return
+                if entry['id'] < log_id:
+                    return
+    
+    def latest(self, limit):
+        """limit dòng mới nhất (mới trước), None nếu ring không đủ dữ liệu"""
+        with self.lock:
+            if limit > len(self.entries) and len(self.entries) == self.entries.maxlen:
+                return None
+            return [self.entries[-i] for i in range(1, min(limit, len(self.entries)) + 1)]
+    
+    def after(self, after_id, limit):
+        """Các dòng có id > after_id (cũ trước), None nếu ring không còn giữ tới after_id"""
+        with self.lock:
+            if self.entries and self.entries[0]['id'] > after_id + 1 and len(self.entries) == self.entries.maxlen:
+                return None
+            newer = []
+            for entry in reversed(self.entries):
+                if entry['id'] <= after_id:
+                    break
+                newer.append(entry)
+        newer.reverse()
+        return newer[:limit]
+
+def log_matches(entry, filters):
+    """Kiểm tra một dòng log (dict) theo bộ lọc như build_log_where()"""
+    for column in ('card_uid', 'direction', 'status', 'door'):
+        if filters.get(column) is not None and entry.get(column) != filters[column]:
+            return False
+    ts = entry.get('ts') or 0
+    if filters.get('from') is not None and ts < filters['from']:
+        return False
+    if filters.get('to') is not None and ts >= filters['to']:
+        return False
+    return True
+
+def format_log_chunk(entries, fmt):
+    """Chuyển một khối log sang text CSV hoặc JSONL"""
+    if fmt == 'jsonl':
+        return ''.join(json.dumps(entry, ensure_ascii=False) + '\n' for entry in entries)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerows([entry.get(column) for column in LOG_COLUMNS] for entry in entries)
+    return buffer.getvalue()
+
+def gzip_stream(chunks):
+    """Nén gzip từng khối text khi đang stream, bộ nhớ không phụ thuộc độ dài"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+# Số ngày giữ access log trong DB trước khi chuyển sang file lưu trữ, 0 = tắt lưu trữ.
+# Mặc định tắt: /api/logs/search và /api/logs/stats chỉ đọc DB, export mới đọc cả lưu trữ.
+LOG_RETENTION_DAYS = int(os.environ.get('RFID_LOG_RETENTION_DAYS', 0))
+
+class LogArchiver(threading.Thread):
+    """Chuyển access log cũ hơn retention_days sang file lưu trữ theo tháng.
+
+    Mỗi tháng một file JSONL nén gzip (access_log-YYYY-MM.jsonl.gz), ghi
+    thêm bằng gzip member mới. Làm theo từng lô nhỏ, mỗi lô một transaction
+    ngắn, nên không chặn việc ghi log mới. File được fsync trước khi xoá dòng
+    khỏi DB; nếu bị dừng giữa chừng, lô đó có thể bị ghi lặp và được bỏ trùng
+    khi đọc lại theo id.
+    
+    Export giữ paused() trong lúc đọc lưu trữ rồi DB: không lô nào được
+    chuyển giữa hai lần đọc, nên mỗi dòng xuất hiện đúng một lần.
+    """
+    
+    FILE_PREFIX = 'access_log-'
+    FILE_SUFFIX = '.jsonl.gz'
+    
+    def __init__(self, pool, archive_dir='log_archive', retention_days=LOG_RETENTION_DAYS, interval=3600, batch_size=5000):
+        super().__init__(name='log-archiver', daemon=True)
+        self.pool = pool
+        self.archive_dir = archive_dir
+        self.retention_days = retention_days
+        self.interval = interval
+        self.batch_size = batch_size
+        self.stop_event = threading.Event()
+        self.rows_archived = 0
+        self.last_run = None
+        self.last_error = None
+        # ts mới nhất đã chuyển khỏi DB, đọc lười từ file lưu trữ cuối
+        self.last_archived_ts = None
+        # Loại trừ giữa các export đang đọc và lô đang chuyển
+        self.export_cond = threading.Condition()
+        self.exports = 0
+        self.archiving = False
+    
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.archive_once()
+            except Exception as e:
+                self.last_error = str(e)
+                logger.error(f"Lỗi lưu trữ access log: {e}")
+            self.stop_event.wait(self.interval)
+    
+    def stop(self):
+        self.stop_event.set()
+        with self.export_cond:
+            self.export_cond.notify_all()
+        if self.is_alive():
+            self.join()
+    
+    @contextmanager
+    def paused(self):
+        """Không chuyển lô mới trong khối with; chờ lô đang chuyển (nếu có) xong"""
+        with self.export_cond:
+            while self.archiving:
+                self.export_cond.wait()
+            self.exports += 1
+        try:
+            yield
+        finally:
+            with self.export_cond:
+                self.exports -= 1
+                self.export_cond.notify_all()
+    
+    def archive_once(self):
+        """Lưu trữ mọi dòng quá hạn, trả về số dòng đã chuyển"""
+        cutoff = int(time.time()) - self.retention_days * 86400
+        total = 0
+        while not self.stop_event.is_set():
+            with self.export_cond:
+                while self.exports and not self.stop_event.is_set():
+                    self.export_cond.wait()
+                if self.stop_event.is_set():
+                    break
+                self.archiving = True
+            try:
+                entries = self._archive_batch(cutoff)
+            finally:
+                with self.export_cond:
+                    self.archiving = False
+                    self.export_cond.notify_all()
+            if not entries:
+                break
+            total += len(entries)
+            self.rows_archived += len(entries)
+            # Nhường DB cho writer giữa các lô
+            time.sleep(0.01)
+        self.last_run = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if total:
+            logger.info(f"Đã lưu trữ {total} access log cũ hơn {self.retention_days} ngày")
+        return total
+    
+    def _archive_batch(self, cutoff):
+        """Chuyển một lô dòng cũ hơn cutoff sang file lưu trữ, trả về các dòng đã chuyển"""
+        with self.pool.connection() as conn:
+            rows = conn.execute(LOG_SELECT + ' WHERE ts < ? ORDER BY id LIMIT ?', (cutoff, self.batch_size)).fetchall()
+        if not rows:
+            return []
+        entries = [dict(zip(LOG_COLUMNS, row)) for row in rows]
+        by_month = {}
+        for entry in entries:
+            by_month.setdefault(self.month_of(entry['ts']), []).append(entry)
+        for month, month_entries in by_month.items():
+            self._append(month, month_entries)
+        with self.pool.connection() as conn:
+            conn.execute('DELETE FROM access_log WHERE id <= ? AND ts < ?', (entries[-1]['id'], cutoff))
+            conn.commit()
+        self.last_archived_ts = max(self.archived_until() or 0, max(entry['ts'] or 0 for entry in entries))
+        return entries
+    
+    def archived_until(self):
+        """ts mới nhất đã chuyển sang lưu trữ (search/stats không thấy các dòng tới mốc này), None nếu chưa có"""
+        if self.last_archived_ts is None:
+            months = self.months()
+            if months:
+                with gzip.open(self.path_for(months[-1]), 'rt', encoding='utf-8') as archive:
+                    self.last_archived_ts = max((json.loads(line)['ts'] or 0 for line in archive), default=None)
+        return self.last_archived_ts
+    
+    @staticmethod
+    def month_of(ts):
+        return datetime.fromtimestamp(ts or 0).strftime('%Y-%m')
+    
+    def path_for(self, month):
+        return os.path.join(self.archive_dir, f'{self.FILE_PREFIX}{month}{self.FILE_SUFFIX}')
+    
+    def _append(self, month, entries):
+        os.makedirs(self.archive_dir, exist_ok=True)
+        with open(self.path_for(month), 'ab') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='ab') as archive:
+                archive.write(format_log_chunk(entries, 'jsonl').encode('utf-8'))
+            raw.flush()
+            os.fsync(raw.fileno())
+    
+    def months(self):
+        """Các tháng đã có file lưu trữ, theo thứ tự thời gian"""
+        if not os.path.isdir(self.archive_dir):
+            return []
+        return sorted(name[len(self.FILE_PREFIX):-len(self.FILE_SUFFIX)] for name in os.listdir(self.archive_dir)
+                      if name.startswith(self.FILE_PREFIX) and name.endswith(self.FILE_SUFFIX))
+    
+    def iter_archived(self, filters, chunk_size=5000):
+        """Đọc các dòng lưu trữ khớp bộ lọc theo từng khối, bỏ trùng theo id"""
+        first = self.month_of(filters['from']) if filters.get('from') is not None else None
+        last = self.month_of(filters['to'] - 1) if filters.get('to') is not None else None
+        for month in self.months():
+            if (first and month < first) or (last and month > last):
+                continue
+            last_id = 0
+            chunk = []
+            with gzip.open(self.path_for(month), 'rt', encoding='utf-8') as archive:
+                for line in archive:
+                    entry = json.loads(line)
+                    if entry['id'] <= last_id:
+                        continue
+                    last_id = entry['id']
+                    if log_matches(entry, filters):
+                        chunk.append(entry)
+                        if len(chunk) >= chunk_size:
+                            yield chunk
+                            chunk = []
+            if chunk:
+                yield chunk
+    
+    def get_stats(self):
+        months = self.months()
+        return {
+            'retention_days': self.retention_days,
+            'rows_archived': self.rows_archived,
+            'archived_until': self.archived_until(),
+            'last_run': self.last_run,
+            'last_error': self.last_error,
+            'archive_months': months,
+            'archive_bytes': sum(os.path.getsize(self.path_for(month)) for month in months)
+        }
+
+# --- Metrics (Prometheus) ---
+# Bucket độ trễ (giây) cho đường nóng: serial, commit DB
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# Bucket thời gian recv() của video track, gồm cả thời gian chờ frame
+RECV_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+class Histogram:
+    """Histogram bucket cố định theo kiểu Prometheus.
+    
+    observe() chỉ là một bisect và hai phép cộng, không khoá: khi hai thread
+    ghi cùng lúc có thể hiếm khi mất một mẫu, chấp nhận được cho giám sát.
+    """
+    
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # Bucket cuối là +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+    
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+def format_metric_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+def redact_url(url):
+    """Bỏ user:password khỏi URL camera trước khi đưa vào label"""
+    parts = urlsplit(url)
+    if not parts.password and not parts.username:
+        return url
+    return parts._replace(netloc=parts.hostname + (f':{parts.port}' if parts.port else '')).geturl()
+
+class PrometheusText:
+    """Ghép output dạng text exposition 0.0.4 của Prometheus"""
+    
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+    
+    def __init__(self):
+        self.lines = []
+    
+    def family(self, name, kind, help_text):
+        self.lines.append(f'# HELP {name} {help_text}')
+        self.lines.append(f'# TYPE {name} {kind}')
+    
+    def sample(self, name, value, labels=None):
+        if isinstance(value, float):
+            value = 'NaN' if value != value else f'{value:.6g}'
+        self.lines.append(f'{name}{format_metric_labels(labels)} {value}')
+    
+    def histogram(self, name, histogram, labels=None):
+        labels = labels or {}
+        counts = list(histogram.counts)
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, counts):
+            cumulative += count
+            self.sample(f'{name}_bucket', cumulative, dict(labels, le=f'{bound:g}'))
+        cumulative += counts[-1]
+        self.sample(f'{name}_bucket', cumulative, dict(labels, le='+Inf'))
+        self.sample(f'{name}_sum', histogram.sum, labels)
+        self.sample(f'{name}_count', cumulative, labels)
+    
+    def render(self):
+        return '\n'.join(self.lines) + '\n'
+
+class LatencyStats:
+    """Giữ các mẫu độ trễ gần nhất để tính p50/p99, kèm histogram cho /metrics"""
+    
+    def __init__(self, window=1000):
+        self.samples = collections.deque(maxlen=window)
+        self.count = 0
+        self.max = 0.0
+        self.histogram = Histogram()
+    
+    def record(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+        if seconds > self.max:
+            self.max = seconds
+        self.histogram.observe(seconds)
+    
+    def get_stats(self):
+        samples = sorted(self.samples)
+        if not samples:
+            return {'count': 0, 'p50_ms': 0, 'p99_ms': 0, 'max_ms': 0}
+        return {
+            'count': self.count,
+            'p50_ms': round(samples[len(samples) // 2] * 1000, 3),
+            'p99_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000, 3),
+            'max_ms': round(self.max * 1000, 3)
+        }
+
+class EventDispatcher(threading.Thread):
+    """Chạy emit/log/ghi DB theo thứ tự trong thread nền.
+
+    Dùng cho mọi việc sau khi đã trả lời ALLOW/DENY, để thread serial đọc
+    được dòng tiếp theo ngay.
+    """
+    
+    def __init__(self, max_queue=10000):
+        super().__init__(name='event-dispatcher', daemon=True)
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.blocked_dispatches = 0
+    
+    def dispatch(self, func, *args):
+        try:
+            self.queue.put_nowait((func, args))
+        except queue.Full:
+            self.blocked_dispatches += 1
+            self.queue.put((func, args))
+    
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            func, args = item
+            try:
+                func(*args)
+            except Exception as e:
+                logger.error(f"Lỗi xử lý sự kiện {getattr(func, '__name__', func)}: {e}")
+    
+    def stop(self):
+        """Dừng sau khi đã chạy hết các sự kiện đang chờ"""
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+
+# --- Serial: parser dòng và chế độ replay ---
+# Khung UID từ code.ino: "[IN/OUT]:UID:[Mã thẻ hex]". Dùng search để vẫn nhận
+# được khung khi đầu dòng bị nhiễu.
+UID_FRAME_RE = re.compile(r'(IN|OUT):UID:([0-9A-Fa-f ]+)$')
+
+def parse_uid_frame(line):
+    """Trả về (direction, uid) nếu dòng là khung UID hợp lệ, ngược lại None"""
+    match = UID_FRAME_RE.search(line)
+    if not match:
+        return None
+    uid = match.group(2).replace(" ", "").upper()
+    if not uid:
+        return None
+    return match.group(1), uid
+
+class SerialLineParser:
+    """Tách luồng byte serial thành từng dòng, chịu được dữ liệu đứt đoạn.
+
+    feed() nhận bao nhiêu byte cũng được (nửa dòng, nhiều dòng) và trả về các
+    dòng hoàn chỉnh. Byte không phải UTF-8 được thay thế thay vì làm ngắt kết
+    nối, dòng quá dài (mất ký tự xuống dòng) bị bỏ.
+    """
+    
+    MAX_LINE_LENGTH = 256
+    
+    def __init__(self):
+        self.buffer = bytearray()
+        self.bytes_received = 0
+        self.lines = 0
+        self.garbled_lines = 0
+        self.overflows = 0
+    
+    def feed(self, data):
+        self.bytes_received += len(data)
+        self.buffer += data
+        lines = []
+        start = 0
+        while True:
+            end = self.buffer.find(b'\n', start)
+            if end < 0:
+                break
+            raw = self.buffer[start:end]
+            start = end + 1
+            if len(raw) > self.MAX_LINE_LENGTH:
+                self.overflows += 1
+                continue
+            line = raw.decode('utf-8', errors='replace').strip().strip('\x00')
+            if not line:
+                continue
+            if '\ufffd' in line:
+                self.garbled_lines += 1
+            self.lines += 1
+            lines.append(line)
+        del self.buffer[:start]
+        if len(self.buffer) > self.MAX_LINE_LENGTH:
+            # Không thấy ký tự xuống dòng quá lâu: bỏ phần rác đã nhận
+            self.overflows += 1
+            self.buffer.clear()
+        return lines
+    
+    def get_stats(self):
+        return {
+            'bytes_received': self.bytes_received,
+            'lines': self.lines,
+            'garbled_lines': self.garbled_lines,
+            'overflows': self.overflows
+        }
+
+class ReplaySerial:
+    """Giả lập serial.Serial từ file ghi lại luồng serial (chế độ replay).
+
+    Kết nối tới cổng "replay:<đường dẫn>" để phát lại file qua đúng đường
+    đọc/parse/trả lời như Arduino thật. baud_rate > 0 thì phát theo tốc độ
+    baud, 0 thì phát nhanh nhất có thể (dùng để benchmark).
+    """
+    
+    def __init__(self, path, baud_rate=0, chunk_size=64):
+        self.file = open(path, 'rb')
+        self.chunk_size = chunk_size
+        # 10 bit cho mỗi byte (8N1)
+        self.byte_time = 10 / baud_rate if baud_rate else 0
+        self.bytes_written = 0
+        self.is_open = True
+    
+    @property
+    def in_waiting(self):
+        return self.chunk_size
+    
+    def read(self, size=1):
+        data = self.file.read(max(size, self.chunk_size))
+        if not data:
+            raise EOFError('Đã phát lại hết file serial')
+        if self.byte_time:
+            time.sleep(len(data) * self.byte_time)
+        return data
+    
+    def write(self, data):
+        self.bytes_written += len(data)
+        return len(data)
+    
+    def close(self):
+        self.is_open = False
+        self.file.close()
+
+def open_serial(com_port, baud_rate):
+    """Mở cổng serial thật, hoặc ReplaySerial với cổng dạng "replay:<file>" """
+    if com_port.startswith('replay:'):
+        return ReplaySerial(com_port[len('replay:'):], baud_rate)
+    return serial.Serial(com_port, baud_rate, timeout=1)
+
+class ArduinoController:
+    """Một bộ điều khiển cửa (Arduino) trên một cổng serial.
+
+    Mỗi controller có thread đọc, parser, đường trả lời và trạng thái riêng;
+    quyết định cho phép, danh sách thẻ và ghi log dùng chung qua RFIDControlSystem.
+    """
+    
+    def __init__(self, system, com_port, baud_rate, name=None, cameras=None):
+        self.system = system
+        self.com_port = com_port
+        self.baud_rate = baud_rate
+        self.name = name or com_port
+        # Hướng ('in'/'out') -> URL camera của cửa này, dùng cho ảnh sự kiện
+        self.cameras = {direction: url for direction, url in (cameras or {}).items() if url}
+        self.serial_connection = None
+        self.is_connected = False
+        self.is_running = False
+        self.serial_thread = None
+        self.parser = SerialLineParser()
+        # Độ trễ từ lúc nhận dòng UID tới lúc gửi xong ALLOW/DENY
+        self.reply_latency = LatencyStats()
+        self.invalid_frames = 0
+        self.connected_at = None
+        self.last_line_at = None
+        self.last_error = None
+    
+    def connect(self):
+        self.serial_connection = open_serial(self.com_port, self.baud_rate)
+        self.is_connected = True
+        self.is_running = True
+        self.connected_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.last_error = None
+        self.serial_thread = threading.Thread(target=self.read_serial_data, name=f'serial-{self.com_port}', daemon=True)
+        self.serial_thread.start()
+    
+    def disconnect(self):
+        self.is_running = False
+        self.is_connected = False
+        if self.serial_connection:
+            self.serial_connection.close()
+            self.serial_connection = None
+    
+    def read_serial_data(self):
+        connection = self.serial_connection
+        while self.is_running and self.is_connected:
+            try:
+                # Chặn tới khi có ít nhất 1 byte (timeout của cổng), rồi lấy
+                # luôn mọi byte đang chờ để xử lý nhiều dòng một lần
+                data = connection.read(max(1, connection.in_waiting))
+                if not data:
+                    continue
+                arrived_at = time.perf_counter()
+                self.last_line_at = time.time()
+                for line in self.parser.feed(data):
+                    self.system.process_arduino_data(line, arrived_at, self)
+            except Exception as e:
+                if self.is_running:
+                    logger.warning(f"[{self.name}] Dừng đọc serial: {e}")
+                    self.last_error = str(e)
+                    self.system.on_controller_failed(self)
+                break
+    
+    def reply(self, response):
+        connection = self.serial_connection
+        if connection:
+            connection.write(response)
+    
+    def get_status(self):
+        return {
+            'com_port': self.com_port,
+            'baud_rate': self.baud_rate,
+            'name': self.name,
+            'cameras': self.cameras,
+            'connected': self.is_connected,
+            'connected_at': self.connected_at,
+            'last_line_at': self.last_line_at,
+            'last_error': self.last_error
+        }
+    
+    def get_stats(self):
+        return dict(self.get_status(),
+                    reply_latency=self.reply_latency.get_stats(),
+                    parser=self.parser.get_stats(),
+                    invalid_frames=self.invalid_frames)
+
+def default_card_name(uid):
+    return f"Thẻ mới - {uid[:8]}"
+
+CARD_IMPORT_COLUMNS = ('uid', 'name', 'group', 'schedule')
+
+def parse_card_import(raw, fmt):
+    """Đọc danh sách thẻ {uid, name, group, schedule} từ CSV hoặc JSON, ValueError nếu sai định dạng"""
+    if fmt == 'json':
+        data = json.loads(raw)
+        if isinstance(data, dict):
+            data = data.get('cards')
+        if not isinstance(data, list):
+            raise ValueError('JSON phải là danh sách thẻ hoặc {"cards": [...]}')
+        rows = [[item.get(key) for key in CARD_IMPORT_COLUMNS] if isinstance(item, dict) else [] for item in data]
+    else:
+        rows = []
+        for row in csv.reader(io.StringIO(raw)):
+            if not row or not any(cell.strip() for cell in row):
+                continue
+            if row[0].strip().lower() == 'uid':
+                # Dòng tiêu đề
+                continue
+            rows.append(row)
+    cards = []
+    for row in rows:
+        row = [str(cell or '').strip() for cell in row] + [''] * len(CARD_IMPORT_COLUMNS)
+        cards.append({'uid': row[0].upper(), 'name': row[1], 'group': row[2] or None, 'schedule': row[3] or None})
+    return cards
+
+DAY_NAMES = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+def split_doors(value):
+    """'A, B' hoặc ['A', 'B'] -> danh sách tên cửa, rỗng nghĩa là mọi cửa"""
+    if isinstance(value, str) or value is None:
+        value = (value or '').split(',')
+    return [door.strip() for door in value if door and door.strip()]
+
+def parse_schedule_days(spec):
+    """'mon-fri', 'sat,sun', '*' -> danh sách thứ (0 = thứ Hai)"""
+    if spec in ('*', 'daily'):
+        return list(range(7))
+    days = []
+    for token in spec.split(','):
+        first, _, last = token.partition('-')
+        if first not in DAY_NAMES or (last and last not in DAY_NAMES):
+            raise ValueError(f'ngày không hợp lệ: {token}')
+        start = DAY_NAMES.index(first)
+        count = (DAY_NAMES.index(last) - start) % 7 + 1 if last else 1
+        days.extend((start + offset) % 7 for offset in range(count))
+    return days
+
+def parse_schedule_minute(value):
+    hour, _, minute = value.partition(':')
+    minutes = int(hour) * 60 + int(minute or 0)
+    if not 0 <= minutes <= MINUTES_PER_DAY:
+        raise ValueError(f'giờ không hợp lệ: {value}')
+    return minutes
+
+def compile_schedule(spec):
+    """Biên dịch lịch 'mon-fri 08:00-18:00; sat 08:00-12:00' thành mặt nạ theo phút trong tuần.
+    
+    Trả về bytes dài MINUTES_PER_WEEK (1 = được phép), hoặc None nếu không
+    giới hạn giờ. Thiếu giờ nghĩa là cả ngày; khoảng qua nửa đêm
+    (22:00-06:00) kéo sang ngày hôm sau.
+    """
+    if not spec or not spec.strip():
+        return None
+    mask = bytearray(MINUTES_PER_WEEK)
+    for part in spec.lower().split(';'):
+        part = part.strip()
+        if not part:
+            continue
+        days_spec, _, hours = part.partition(' ')
+        hours = hours.strip()
+        start, end = 0, MINUTES_PER_DAY
+        if hours:
+            first, sep, last = hours.partition('-')
+            if not sep:
+                raise ValueError(f'khoảng giờ không hợp lệ: {hours}')
+            start, end = parse_schedule_minute(first), parse_schedule_minute(last)
+        length = end - start if end > start else end + MINUTES_PER_DAY - start
+        for day in parse_schedule_days(days_spec):
+            begin = day * MINUTES_PER_DAY + start
+            for minute in range(begin, begin + length):
+                mask[minute % MINUTES_PER_WEEK] = 1
+    return bytes(mask)
+
+def combine_schedules(first, second):
+    """Giao của hai mặt nạ lịch, None là không giới hạn"""
+    if first is None or second is None:
+        return first if second is None else second
+    return bytes(a & b for a, b in zip(first, second))
+
+class AccessPolicy:
+    """Quyết định ALLOW/DENY theo nhóm cửa, khung giờ và anti-passback trong O(1).
+    
+    Mỗi tổ hợp (nhóm, lịch riêng của thẻ) được biên dịch một lần thành rule
+    (tập cửa, mặt nạ phút trong tuần); thẻ chỉ giữ chỉ số rule nên hàng triệu
+    thẻ dùng chung vài rule. Rule đếm số thẻ dùng nó và được giải phóng (cùng
+    mặt nạ lịch) khi không còn thẻ nào. Sửa nhóm chỉ biên dịch lại các rule
+    của nhóm đó.
+    Trạng thái có mặt (hướng được phép gần nhất của mỗi thẻ) giữ trong bộ
+    nhớ và được nạp từ access_log khi khởi động.
+    """
+    
+    def __init__(self):
+        # name -> {'name', 'doors', 'schedule'} như lưu trong DB
+        self.groups = {}
+        # name -> (frozenset cửa hoặc None, mặt nạ lịch hoặc None)
+        self.group_rules = {}
+        # rule_id -> (cửa, mặt nạ); (nhóm, lịch) <-> rule_id; rule_id -> số thẻ dùng
+        self.rules = {}
+        self.rule_ids = {}
+        self.rule_keys = {}
+        self.rule_refs = {}
+        self.next_rule_id = itertools.count()
+        self.card_rules = {}
+        self.presence = {}
+        self.anti_passback = False
+        # Mặt nạ lịch riêng của thẻ -> số rule dùng nó
+        self.schedule_cache = {}
+        self.schedule_refs = collections.Counter()
+        self.lock = threading.Lock()
+        self._minute = (None, 0)
+    
+    def compile_schedule(self, spec):
+        spec = spec or None
+        if spec not in self.schedule_cache:
+            self.schedule_cache[spec] = compile_schedule(spec)
+        return self.schedule_cache[spec]
+    
+    def _compile_rule(self, key):
+        group, schedule = key
+        doors, mask = None, None
+        if group is not None:
+            # Nhóm không tồn tại (đã xoá): không mở cửa nào
+            doors, mask = self.group_rules.get(group, (frozenset(), None))
+        return doors, combine_schedules(mask, self.compile_schedule(schedule))
+    
+    def _acquire_rule(self, entry):
+        key = (entry.get('group') or None, entry.get('schedule') or None)
+        rule_id = self.rule_ids.get(key)
+        if rule_id is None:
+            rule_id = next(self.next_rule_id)
+            self.schedule_refs[key[1]] += 1
+            self.rules[rule_id] = self._compile_rule(key)
+            self.rule_ids[key] = rule_id
+            self.rule_keys[rule_id] = key
+            self.rule_refs[rule_id] = 0
+        self.rule_refs[rule_id] += 1
+        return rule_id
+    
+    def _release_rule(self, rule_id):
+        self.rule_refs[rule_id] -= 1
+        if self.rule_refs[rule_id]:
+            return
+        # Không còn thẻ nào dùng: bỏ rule và mặt nạ lịch nếu không rule nào khác cần
+        del self.rule_refs[rule_id]
+        key = self.rule_keys.pop(rule_id)
+        del self.rule_ids[key]
+        del self.rules[rule_id]
+        self.schedule_refs[key[1]] -= 1
+        if not self.schedule_refs[key[1]]:
+            del self.schedule_refs[key[1]]
+            self.schedule_cache.pop(key[1], None)
+    
+    def validate(self, entry):
+        """ValueError nếu lịch của thẻ không hợp lệ"""
+        schedule = entry.get('schedule') or None
+        if schedule not in self.schedule_cache:
+            # Chỉ kiểm tra, chưa cache: thẻ có thể không được ghi
+            compile_schedule(schedule)
+    
+    def set_cards(self, entries):
+        with self.lock:
+            for entry in entries:
+                rule_id = self._acquire_rule(entry)
+                previous = self.card_rules.get(entry['uid'])
+                self.card_rules[entry['uid']] = rule_id
+                if previous is not None:
+                    self._release_rule(previous)
+    
+    def remove_card(self, uid):
+        with self.lock:
+            rule_id = self.card_rules.pop(uid, None)
+            if rule_id is not None:
+                self._release_rule(rule_id)
+    
+    def set_group(self, name, doors, schedule):
+        """Thêm/sửa nhóm; doors rỗng nghĩa là mọi cửa"""
+        # Mặt nạ của nhóm nằm trong group_rules, không qua cache lịch của thẻ
+        mask = compile_schedule(schedule)
+        with self.lock:
+            self.groups[name] = {'name': name, 'doors': list(doors or []), 'schedule': schedule or None}
+            self.group_rules[name] = (frozenset(doors) if doors else None, mask)
+            self._recompile_group(name)
+    
+    def remove_group(self, name):
+        with self.lock:
+            self.groups.pop(name, None)
+            self.group_rules.pop(name, None)
+            self._recompile_group(name)
+    
+    def _recompile_group(self, name):
+        for key, rule_id in self.rule_ids.items():
+            if key[0] == name:
+                self.rules[rule_id] = self._compile_rule(key)
+    
+    def seed_presence(self, rows):
+        self.presence.update(rows)
+    
+    def minute_of_week(self, now):
+        minute = int(now // 60)
+        cached = self._minute
+        if cached[0] != minute:
+            local = time.localtime(minute * 60)
+            cached = (minute, local.tm_wday * MINUTES_PER_DAY + local.tm_hour * 60 + local.tm_min)
+            self._minute = cached
+        return cached[1]
+    
+    def decide(self, uid, direction, door, now=None):
+        """Trả về (allowed, lý do từ chối); lần quét được phép cập nhật trạng thái có mặt"""
+        rule_id = self.card_rules.get(uid)
+        if rule_id is None:
+            return False, 'thẻ chưa đăng ký'
+        rule = self.rules.get(rule_id)
+        if rule is None:
+            # Thẻ vừa đổi quyền và rule cũ đã được giải phóng: dùng rule mới
+            rule = self.rules.get(self.card_rules.get(uid), (frozenset(), None))
+        doors, mask = rule
+        if doors is not None and door not in doors:
+            return False, 'không được phép ở cửa này'
+        if mask is not None and not mask[self.minute_of_week(time.time() if now is None else now)]:
+            return False, 'ngoài khung giờ'
+        if self.anti_passback:
+            last = self.presence.get(uid)
+            if direction == 'IN' and last == 'IN':
+                return False, 'chưa quét ra'
+            if direction == 'OUT' and last != 'IN':
+                return False, 'chưa quét vào'
+        self.presence[uid] = direction
+        return True, None
+    
+    def get_stats(self):
+        return {
+            'cards': len(self.card_rules),
+            'rules': len(self.rules),
+            'schedules': len(self.schedule_cache),
+            'groups': len(self.groups),
+            'anti_passback': self.anti_passback,
+            'present': sum(1 for direction in list(self.presence.values()) if direction == 'IN')
+        }
+
+class CardDirectory:
+    """Danh bạ thẻ uid -> {uid, name, group, schedule, created_at} trong bộ nhớ, khớp với bảng authorized_cards.
+    
+    Thay đổi được commit vào SQLite trước rồi mới áp vào bộ nhớ và
+    AccessPolicy, tuần tự qua write_lock. Mỗi entry được thay thế chứ không
+    sửa tại chỗ nên việc đọc (`uid in directory`) không cần khoá.
+    """
+    
+    def __init__(self, pool, policy):
+        self.pool = pool
+        self.policy = policy
+        self.cards = {}
+        self.write_lock = threading.Lock()
+    
+    def load(self):
+        with self.pool.connection() as conn:
+            rows = conn.execute('SELECT uid, name, group_name, schedule, created_at FROM authorized_cards').fetchall()
+        self.cards = {uid: {'uid': uid, 'name': name, 'group': group, 'schedule': schedule, 'created_at': created_at}
+                      for uid, name, group, schedule, created_at in rows}
+        self.policy.set_cards(self.cards.values())
+    
+    def __contains__(self, uid):
+        return uid in self.cards
+    
+    def __len__(self):
+        return len(self.cards)
+    
+    def get(self, uid):
+        return self.cards.get(uid)
+    
+    def remember(self, uid, name):
+        """Cho phép thẻ ngay trong bộ nhớ, upsert() sẽ ghi nó vào DB sau"""
+        entry = {'uid': uid, 'name': name, 'group': None, 'schedule': None, 'created_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+        if self.cards.setdefault(uid, entry) is entry:
+            self.policy.set_cards([entry])
+    
+    def upsert(self, cards):
+        """Thêm/cập nhật nhiều thẻ trong một transaction, trả về các entry mới.
+    
+        Mỗi thẻ là dict có uid và các trường cần đổi (name, group, schedule);
+        trường không có giữ giá trị cũ. ValueError nếu có lịch không hợp lệ.
+        """
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self.write_lock:
+            merged = {}
+            for card in cards:
+                current = merged.get(card['uid']) or self.cards.get(card['uid']) or {'group': None, 'schedule': None, 'created_at': timestamp}
+                merged[card['uid']] = dict(current, **card)
+            entries = list(merged.values())
+            for entry in entries:
+                self.policy.validate(entry)
+            with self.pool.connection() as conn:
+                conn.executemany('''
+                    INSERT INTO authorized_cards (uid, name, group_name, schedule, created_at) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(uid) DO UPDATE SET name = excluded.name, group_name = excluded.group_name, schedule = excluded.schedule
+                ''', [(entry['uid'], entry['name'], entry['group'], entry['schedule'], entry['created_at']) for entry in entries])
+                conn.commit()
+            for entry in entries:
+                self.cards[entry['uid']] = entry
+            self.policy.set_cards(entries)
+        return entries
+    
+    def update(self, uid, **fields):
+        """Sửa name/group/schedule của một thẻ đã có, trả về entry mới hoặc None nếu không có thẻ"""
+        with self.write_lock:
+            current = self.cards.get(uid)
+            if current is None:
+                return None
+            entry = dict(current, **fields)
+            self.policy.validate(entry)
+            with self.pool.connection() as conn:
+                updated = conn.execute('UPDATE authorized_cards SET name = ?, group_name = ?, schedule = ? WHERE uid = ?',
+                                       (entry['name'], entry['group'], entry['schedule'], uid)).rowcount
+                conn.commit()
+            if not updated:
+                return None
+            self.cards[uid] = entry
+            self.policy.set_cards([entry])
+        return entry
+    
+    def remove(self, uid):
+        """Xoá một thẻ, trả về True nếu thẻ tồn tại"""
+        with self.write_lock:
+            with self.pool.connection() as conn:
+                deleted = conn.execute('DELETE FROM authorized_cards WHERE uid = ?', (uid,)).rowcount
+                conn.commit()
+            self.policy.remove_card(uid)
+            return self.cards.pop(uid, None) is not None or deleted > 0
+    
+    def list(self):
+        return sorted(self.cards.values(), key=lambda entry: entry['created_at'] or '', reverse=True)
 
-                    if self.cap.isOpened():
-                        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
-                        logger.info(f"[{self.direction}] Kết nối camera thành công!")
-                        
-                        # Báo hiệu rằng camera đã sẵn sàng
-                        self.loop.call_soon_threadsafe(self.ready_event.set)
-                        retry_count = 0
-                    else:
-                        logger.error(f"[{self.direction}] Không thể kết nối camera")
-                        retry_count += 1
-                        time.sleep(2)
-                        continue
-                
-                # Đọc frame
-                ret, frame = self.cap.read()
-                if ret and frame is not None:
-                    with self.frame_lock:
-                        self.latest_frame = frame.copy()
-                    time.sleep(1/30)
-                else:
-                    logger.warning(f"[{self.direction}] Không đọc được frame từ camera. Thử kết nối lại...")
-                    if self.cap:
-                        self.cap.release()
-                        self.cap = None
-                    retry_count += 1
-                    time.sleep(1)
-                    
-            except Exception as e:
-                logger.error(f"[{self.direction}] Lỗi camera reader: {e}")
-                if self.cap:
-                    self.cap.release()
-                    self.cap = None
-                retry_count += 1
-                time.sleep(2)
-        
-        logger.warning(f"[{self.direction}] Camera reader dừng sau {retry_count} lần thử")
-        self.cleanup()
+SNAPSHOT_DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+
+class SnapshotStore:
+    """Kho ảnh JPEG đánh địa chỉ theo nội dung (SHA-256) trên đĩa.
     
-    def get_frame(self):
-        """Thread-safe lấy frame mới nhất"""
-        with self.frame_lock:
-            return self.latest_frame.copy() if self.latest_frame is not None else None
+    Mỗi ảnh có bản gốc <digest>.jpg và thumbnail <digest>_thumb.jpg trong
+    thư mục con theo 2 ký tự đầu. Ảnh trùng nội dung chỉ lưu một lần. Khi
+    tổng dung lượng vượt max_bytes, xoá ảnh cũ nhất tới còn 90% giới hạn;
+    access_log vẫn giữ digest, endpoint trả 404 cho ảnh đã bị xoá.
+    """
     
-    def cleanup(self):
-        """Dọn dẹp resources"""
-        self.is_running = False
-        if self.cap:
-            self.cap.release()
-            self.cap = None
-        logger.info(f"[{self.direction}] Camera reader đã dọn dẹp")
+    def __init__(self, root='snapshots', max_bytes=1 << 30):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # digest -> tổng số byte (ảnh + thumbnail), thứ tự cũ trước
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        self.evicted = 0
+        self._load()
     
-    def stop(self):
-        """Dừng camera reader"""
-        self.cleanup()
+    def _load(self):
+        if not os.path.isdir(self.root):
+            return
+        found = {}
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                digest = name.split('.')[0].split('_')[0]
+                if not SNAPSHOT_DIGEST_RE.match(digest):
+                    continue
+                stat = os.stat(os.path.join(directory, name))
+                size, mtime = found.get(digest, (0, 0))
+                found[digest] = (size + stat.st_size, max(mtime, stat.st_mtime))
+        for digest, (size, _) in sorted(found.items(), key=lambda item: item[1][1]):
+            self.entries[digest] = size
+            self.total_bytes += size
+    
+    def path(self, digest, thumb=False):
+        return os.path.join(self.root, digest[:2], f'{digest}_thumb.jpg' if thumb else f'{digest}.jpg')
+    
+    def put(self, jpeg, thumb):
+        """Lưu ảnh (bytes JPEG) và thumbnail, trả về digest"""
+        digest = hashlib.sha256(jpeg).hexdigest()
+        with self.lock:
+            if digest in self.entries:
+                self.entries.move_to_end(digest)
+                return digest
+        os.makedirs(os.path.dirname(self.path(digest)), exist_ok=True)
+        for path, data in ((self.path(digest), jpeg), (self.path(digest, thumb=True), thumb)):
+            # Ghi file tạm rồi rename để không bao giờ phục vụ ảnh ghi dở
+            temp_path = f'{path}.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        with self.lock:
+            self.entries[digest] = len(jpeg) + len(thumb)
+            self.total_bytes += len(jpeg) + len(thumb)
+            if self.total_bytes > self.max_bytes:
+                self._evict(self.max_bytes * 0.9)
+        return digest
+    
+    def _evict(self, target_bytes):
+        while self.entries and self.total_bytes > target_bytes:
+            digest, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evicted += 1
+            for path in (self.path(digest), self.path(digest, thumb=True)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+    
+    def get_stats(self):
+        return {
+            'snapshots': len(self.entries),
+            'total_bytes': self.total_bytes,
+            'max_bytes': self.max_bytes,
+            'evicted': self.evicted
+        }
 
-class OpenCVVideoStreamTrack(MediaStreamTrack):
-    """Custom video track cho aiortc từ OpenCV"""
+class EventSnapshotter:
+    """Chụp frame camera cho mỗi lần quét thẻ và mã hoá JPEG trong pool thread nền.
     
-    kind = "video"
+    capture() chạy trên đường nóng sau khi đã trả lời Arduino: chỉ giữ tham
+    chiếu tới buffer i420 read-only mới nhất (không copy) và đẩy việc vào
+    pool. Nhiều lần quét trùng một frame được gộp vào một việc; khi số việc
+    đang chờ đạt max_pending thì bỏ ảnh của lần quét mới thay vì chờ.
     
-    def __init__(self, camera_reader):
-        super().__init__()
-        self.camera_reader = camera_reader
-        
-    async def recv(self):
-        """Nhận frame tiếp theo cho WebRTC stream"""
-        pts, time_base = await self.next_timestamp()
-        
-        frame = self.camera_reader.get_frame()
-        
-        if frame is None:
-            # Nếu không có frame, đợi một chút và tạo frame đen
-            await asyncio.sleep(0.02)
-            frame = np.zeros((480, 640, 3), dtype=np.uint8)
-            cv2.putText(frame, "No Signal", (250, 240), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
-        
-        frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        
-        av_frame = av.VideoFrame.from_ndarray(frame_rgb, format="rgb24")
-        av_frame.pts = pts
-        av_frame.time_base = time_base
-        
-        return av_frame
+    Chỉ chụp camera được gán cho cửa và hướng quét (cameras của controller);
+    cửa chưa gán camera thì tính vào no_frame chứ không lấy camera khác.
+    """
+    
+    def __init__(self, store, on_stored, workers=2, max_pending=16, quality=80, thumb_width=160):
+        self.store = store
+        self.on_stored = on_stored
+        self.max_pending = max_pending
+        self.quality = quality
+        self.thumb_width = thumb_width
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='snapshot')
+        self.lock = threading.Lock()
+        # (id reader, seq) -> các log id đang chờ ảnh của frame đó
+        self.pending = {}
+        # Thống kê
+        self.captured = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.no_frame = 0
+        self.failed = 0
+    
+    def capture(self, log_id, camera):
+        """Chụp ảnh cho access log từ camera (URL) của cửa; không có camera hay camera không chạy thì bỏ qua"""
+        frame = capture_hub.latest_frame(camera) if camera else None
+        if frame is not None:
+            reader, seq, i420 = frame
+        else:
+            # Camera đang chỉ grab(): worker xin frame kế tiếp rồi mới mã hoá
+            reader, seq, i420 = capture_hub.reader_for(camera) if camera else None, None, None
+            if reader is None:
+                self.no_frame += 1
+                return
+        key = (id(reader), seq)
+        with self.lock:
+            log_ids = self.pending.get(key)
+            if log_ids is not None:
+                log_ids.append(log_id)
+                self.coalesced += 1
+                return
+            if len(self.pending) >= self.max_pending:
+                self.dropped += 1
+                return
+            self.pending[key] = [log_id]
+        self.executor.submit(self._encode, key, i420, reader)
+    
+    def _encode(self, key, i420, reader):
+        digest = None
+        try:
+            if i420 is None:
+                _, i420, _ = reader.wait_video_frame_blocking(reader.latest_video[0], timeout=1.0)
+            if i420 is None:
+                raise RuntimeError(f"camera {redact_url(reader.url)} không trả frame")
+            bgr = cv2.cvtColor(i420, cv2.COLOR_YUV2BGR_I420)
+            ok, jpeg = cv2.imencode('.jpg', bgr, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            height, width = bgr.shape[:2]
+            thumb_size = (self.thumb_width, max(1, height * self.thumb_width // width))
+            thumb_ok, thumb = cv2.imencode('.jpg', cv2.resize(bgr, thumb_size, interpolation=cv2.INTER_AREA),
+                                           [cv2.IMWRITE_JPEG_QUALITY, 70])
+            if ok and thumb_ok:
+                digest = self.store.put(jpeg.tobytes(), thumb.tobytes())
+        except Exception as e:
+            logger.error(f"Lỗi lưu ảnh sự kiện: {e}")
+        with self.lock:
+            log_ids = self.pending.pop(key)
+        if digest is None:
+            self.failed += 1
+            return
+        self.captured += len(log_ids)
+        self.on_stored(log_ids, digest)
+    
+    def stop(self):
+        self.executor.shutdown(wait=True)
+    
+    def get_stats(self):
+        return dict(self.store.get_stats(),
+                    pending=len(self.pending),
+                    captured=self.captured,
+                    coalesced=self.coalesced,
+                    dropped=self.dropped,
+                    no_frame=self.no_frame,
+                    failed=self.failed)
 
 # --- RFID System Class (Giữ nguyên) ---
 class RFIDControlSystem:
-    def __init__(self):
-        self.serial_connection = None
-        self.is_connected = False
-        self.is_running = False
-        self.current_com_port = "COM3"
-        self.current_baud_rate = 9600
-        self.db_path = 'rfid_log.db'
+    def __init__(self, db_path='rfid_log.db', log_retention_days=LOG_RETENTION_DAYS):
+        # com_port -> ArduinoController, mỗi cửa một controller
+        self.controllers = {}
+        self.controllers_lock = threading.Lock()
+        self.db_path = db_path
+        self.db_pool = ConnectionPool(self.db_path)
         self.init_database()
-        self.authorized_cards = set()
-        self.load_authorized_cards()
-        self.serial_thread = None
+        # Id access log cấp ở bộ nhớ để sự kiện delta có id tăng dần ngay khi ghi
+        self.log_id_lock = threading.Lock()
+        self.log_ids = itertools.count(self.get_max_log_id() + 1)
+        self.recent_logs = RecentLogBuffer()
+        self.recent_logs.extend(reversed(self.query_logs_before(None, self.recent_logs.entries.maxlen)))
+        self.policy = AccessPolicy()
+        self.cards = CardDirectory(self.db_pool, self.policy)
+        self.load_access_policy()
         self.auto_add_mode = False
+        # (door, allow/deny) -> số lượt quét, cho /metrics
+        self.scan_counts = collections.Counter()
+        self.log_writer = AccessLogWriter(self.db_pool, on_commit=self.on_logs_committed)
+        self.log_writer.start()
+        self.dispatcher = EventDispatcher()
+        self.dispatcher.start()
+        # retention 0: vẫn đọc được file lưu trữ cũ nhưng không chuyển thêm dòng nào
+        self.log_archiver = LogArchiver(self.db_pool, retention_days=log_retention_days)
+        if log_retention_days > 0:
+            self.log_archiver.start()
+        self.snapshots = EventSnapshotter(SnapshotStore(), on_stored=self.on_snapshot_stored)
+        atexit.register(self.shutdown)
 
-    @contextmanager
     def get_db_connection(self):
-        conn = sqlite3.connect(self.db_path)
-        try:
-            yield conn
-        finally:
-            conn.close()
+        return self.db_pool.connection()
+    
+    def shutdown(self):
+        """Ghi nốt access log đang chờ và đóng kết nối DB"""
+        for controller in list(self.controllers.values()):
+            controller.disconnect()
+        self.log_archiver.stop()
+        self.snapshots.stop()
+        self.dispatcher.stop()
+        self.log_writer.stop()
+        self.db_pool.close()
     
     def init_database(self):
         with self.get_db_connection() as conn:
@@ -181,187 +2554,570 @@ class RFIDControlSystem:
                     timestamp TEXT,
                     direction TEXT,
                     card_uid TEXT,
-                    status TEXT
+                    status TEXT,
+                    door TEXT,
+                    ts INTEGER,
+                    snapshot TEXT
                 )
             ''')
+            migrate_access_log(conn)
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS authorized_cards (
                     uid TEXT PRIMARY KEY,
                     name TEXT,
-                    created_at TEXT
+                    created_at TEXT,
+                    group_name TEXT,
+                    schedule TEXT
+                )
+            ''')
+            migrate_authorized_cards(conn)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS access_groups (
+                    name TEXT PRIMARY KEY,
+                    doors TEXT,
+                    schedule TEXT
                 )
             ''')
             conn.commit()
     
-    def load_authorized_cards(self):
+    def get_max_log_id(self):
         with self.get_db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('SELECT uid FROM authorized_cards')
-            self.authorized_cards = {row[0] for row in cursor.fetchall()}
+            cursor.execute('SELECT MAX(id) FROM access_log')
+            max_id = cursor.fetchone()[0] or 0
+            # AUTOINCREMENT không dùng lại id của dòng đã xoá
+            cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'access_log'")
+            row = cursor.fetchone()
+            return max(max_id, row[0] if row else 0)
     
-    def connect_arduino(self, com_port, baud_rate):
+    def load_access_policy(self):
+        """Nạp nhóm, thẻ và trạng thái có mặt (lần quét được phép gần nhất) vào AccessPolicy"""
+        with self.get_db_connection() as conn:
+            groups = conn.execute('SELECT name, doors, schedule FROM access_groups').fetchall()
+            # Cột trần đi cùng MAX(id) lấy từ đúng dòng có id lớn nhất
+            presence = conn.execute('''
+                SELECT card_uid, direction, MAX(id) FROM access_log
+                WHERE status = ? GROUP BY card_uid
+            ''', (STATUS_ALIASES['ALLOW'],)).fetchall()
+        for name, doors, schedule in groups:
+            try:
+                self.policy.set_group(name, split_doors(doors), schedule)
+            except ValueError as e:
+                logger.error(f"Lịch của nhóm {name} không hợp lệ, nhóm bị khoá: {e}")
+        self.cards.load()
+        self.policy.seed_presence((uid, direction) for uid, direction, _ in presence)
+
+    def connect_arduino(self, com_port, baud_rate, name=None, cameras=None):
+        """Kết nối (hoặc kết nối lại) controller trên com_port, không ảnh hưởng các cổng khác.
+
+        cameras: {'in': URL, 'out': URL} camera của cửa này; thiếu thì lượt
+        quét ở hướng đó không có ảnh sự kiện.
+        """
         try:
-            if self.is_connected:
-                self.disconnect_arduino()
-            self.serial_connection = serial.Serial(com_port, baud_rate, timeout=1)
-            self.is_connected = True
-            self.is_running = True
-            self.current_com_port = com_port
-            self.current_baud_rate = baud_rate
-            self.serial_thread = threading.Thread(target=self.read_serial_data, daemon=True)
-            self.serial_thread.start()
-            socketio.emit('connection_status', {'status': 'connected', 'message': f'Đã kết nối với Arduino trên {com_port}'})
-            return True, f'Đã kết nối với Arduino trên {com_port}'
+            with self.controllers_lock:
+                old = self.controllers.pop(com_port, None)
+                if old:
+                    old.disconnect()
+                controller = ArduinoController(self, com_port, baud_rate, name, cameras)
+                controller.connect()
+                self.controllers[com_port] = controller
+            message = f'Đã kết nối với Arduino trên {com_port}'
+            socketio.emit('connection_status', {'status': 'connected', 'message': message, 'controller': controller.get_status()})
+            return True, message
         except Exception as e:
-            message = f'Không thể kết nối: {str(e)}'
-            socketio.emit('connection_status', {'status': 'error', 'message': message})
+            message = f'Không thể kết nối {com_port}: {str(e)}'
+            socketio.emit('connection_status', {'status': 'error', 'message': message, 'controller': {'com_port': com_port, 'connected': False}})
             return False, message
     
-    def disconnect_arduino(self):
-        self.is_running = False
-        self.is_connected = False
-        if self.serial_connection:
-            self.serial_connection.close()
-            self.serial_connection = None
-        socketio.emit('connection_status', {'status': 'disconnected', 'message': 'Đã ngắt kết nối với Arduino'})
+    def disconnect_arduino(self, com_port=None):
+        """Ngắt controller trên com_port, hoặc tất cả nếu không chỉ định"""
+        with self.controllers_lock:
+            if com_port is None:
+                controllers = list(self.controllers.values())
+                self.controllers.clear()
+            else:
+                controller = self.controllers.pop(com_port, None)
+                controllers = [controller] if controller else []
+        for controller in controllers:
+            controller.disconnect()
+            socketio.emit('connection_status', {'status': 'disconnected', 'message': f'Đã ngắt kết nối với Arduino trên {controller.com_port}', 'controller': controller.get_status()})
+        return len(controllers) > 0
     
-    def read_serial_data(self):
-        while self.is_running and self.is_connected:
-            try:
-                if self.serial_connection and self.serial_connection.in_waiting > 0:
-                    line = self.serial_connection.readline().decode('utf-8').strip()
-                    if line:
-                        self.process_arduino_data(line)
-                time.sleep(0.1)
-            except Exception:
-                self.disconnect_arduino()
-                break
+    def on_controller_failed(self, controller):
+        """Controller mất kết nối: giữ trong danh sách để UI thấy lỗi, đóng cổng"""
+        controller.disconnect()
+        socketio.emit('connection_status', {'status': 'error', 'message': f'Mất kết nối Arduino trên {controller.com_port}: {controller.last_error}', 'controller': controller.get_status()})
     
-    def process_arduino_data(self, data):
-        socketio.emit('log_message', {'message': f'Arduino: {data}'})
-        if ":UID:" in data:
-            try:
-                parts = data.split(":UID:")
-                direction = parts[0]
-                uid = parts[1].replace(" ", "").upper()
-                
-                if self.auto_add_mode and direction == "IN" and uid not in self.authorized_cards:
-                    default_name = f"Thẻ mới - {uid[:8]}"
-                    self.add_card(uid, default_name)
-                    response = "ALLOW"
-                    status = "Cho phép"
-                    socketio.emit('log_message', {'message': f'✨ Thẻ mới {uid} được tự động thêm và cho phép vào.'})
-                    socketio.emit('access_granted', {'uid': uid, 'direction': direction})
-                else:
-                    if uid in self.authorized_cards:
-                        response = "ALLOW"
-                        status = "Cho phép"
-                        socketio.emit('log_message', {'message': f'✓ Thẻ {uid} được phép {direction}'})
-                        socketio.emit('access_granted', {'uid': uid, 'direction': direction})
-                    else:
-                        response = "DENY"
-                        status = "Từ chối"
-                        socketio.emit('log_message', {'message': f'✗ Thẻ {uid} không được phép {direction}'})
-                        socketio.emit('access_denied', {'uid': uid, 'direction': direction})
-                
-                if self.serial_connection:
-                    self.serial_connection.write((response + "\n").encode())
-                
-                self.save_access_log(direction, uid, status)
-                socketio.emit('logs_updated', self.get_recent_logs())
-            except Exception as e:
-                socketio.emit('log_message', {'message': f'Lỗi xử lý dữ liệu: {str(e)}'})
+    @property
+    def is_connected(self):
+        return any(controller.is_connected for controller in self.controllers.values())
+    
+    def process_arduino_data(self, data, arrived_at=None, controller=None):
+        """Quyết định ALLOW/DENY từ dữ liệu trong bộ nhớ và trả lời ngay.
 
-    def save_access_log(self, direction, uid, status):
-        with self.get_db_connection() as conn:
-            cursor = conn.cursor()
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            cursor.execute('INSERT INTO access_log (timestamp, direction, card_uid, status) VALUES (?, ?, ?, ?)',(timestamp, direction, uid, status))
-            conn.commit()
+        Ghi log, emit tới UI và ghi thẻ tự động thêm được đẩy sang
+        dispatcher/log writer sau khi đã trả lời Arduino.
+        """
+        if arrived_at is None:
+            arrived_at = time.perf_counter()
+        door = controller.name if controller else None
+        if ":UID:" not in data:
+            self.dispatcher.dispatch(self.publish_arduino_message, data, door)
+            return
+        try:
+            frame = parse_uid_frame(data)
+            if frame is None:
+                # Khung UID bị nhiễu: Arduino vẫn đang chờ nên trả lời DENY ngay
+                if controller:
+                    controller.reply(b"DENY\n")
+                    controller.invalid_frames += 1
+                self.dispatcher.dispatch(self.publish_arduino_message, data, door, f'✗ Khung UID không hợp lệ, đã từ chối: {data}')
+                return
+            direction, uid = frame
+            
+            auto_added = False
+            if self.auto_add_mode and direction == "IN" and uid not in self.cards:
+                # Cho phép ngay, thẻ được ghi vào DB ở dispatcher
+                self.cards.remember(uid, default_card_name(uid))
+                auto_added = True
+            allowed, reason = self.policy.decide(uid, direction, door)
+            
+            response = b"ALLOW\n" if allowed else b"DENY\n"
+            if controller:
+                controller.reply(response)
+                controller.reply_latency.record(time.perf_counter() - arrived_at)
+            
+            status = "Cho phép" if allowed else "Từ chối"
+            self.scan_counts[(door, 'allow' if allowed else 'deny')] += 1
+            log_id = self.save_access_log(direction, uid, status, door)
+            camera = controller.cameras.get(direction.lower()) if controller else None
+            capture_hub.wake(camera)
+            self.snapshots.capture(log_id, camera)
+            self.dispatcher.dispatch(self.publish_access_event, data, direction, uid, status, auto_added, door, reason)
+        except Exception as e:
+            self.dispatcher.dispatch(self.publish_arduino_message, data, door, f'Lỗi xử lý dữ liệu: {str(e)}')
+    
+    def publish_arduino_message(self, data, door=None, error=None):
+        prefix = f'Arduino {door}' if door else 'Arduino'
+        socketio.emit('log_message', {'message': f'{prefix}: {data}', 'door': door})
+        if error:
+            socketio.emit('log_message', {'message': error, 'door': door})
+    
+    def publish_access_event(self, data, direction, uid, status, auto_added, door=None, reason=None):
+        """Chạy trên dispatcher: thông báo UI về một lần quét thẻ"""
+        self.publish_arduino_message(data, door)
+        event = {'uid': uid, 'direction': direction, 'door': door, 'reason': reason}
+        if auto_added:
+            self.add_card(uid, default_card_name(uid))
+        if auto_added and status == "Cho phép":
+            socketio.emit('log_message', {'message': f'✨ Thẻ mới {uid} được tự động thêm và cho phép vào.', 'door': door})
+            socketio.emit('access_granted', event)
+        elif status == "Cho phép":
+            socketio.emit('log_message', {'message': f'✓ Thẻ {uid} được phép {direction}', 'door': door})
+            socketio.emit('access_granted', event)
+        else:
+            socketio.emit('log_message', {'message': f'✗ Thẻ {uid} không được phép {direction} ({reason})', 'door': door})
+            socketio.emit('access_denied', event)
+
+    def save_access_log(self, direction, uid, status, door=None):
+        now = datetime.now()
+        timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
+        # Cấp id và đưa vào hàng đợi cùng lúc để thứ tự ghi khớp thứ tự id
+        with self.log_id_lock:
+            log_id = next(self.log_ids)
+            self.log_writer.submit((log_id, timestamp, direction, uid, status, door, int(now.timestamp()), None))
+        return log_id
+    
+    def on_logs_committed(self, rows, updates=()):
+        """Chạy trên thread writer sau mỗi lô commit: chỉ gửi các dòng mới và ảnh mới cho UI"""
+        if rows:
+            entries = [dict(zip(LOG_COLUMNS, row)) for row in rows]
+            self.recent_logs.extend(entries)
+            socketio.emit('logs_added', entries)
+        if updates:
+            for update in updates:
+                self.recent_logs.update(update.log_id, snapshot=update.digest)
+            socketio.emit('log_snapshots', [{'id': update.log_id, 'snapshot': update.digest} for update in updates])
+    
+    def on_snapshot_stored(self, log_ids, digest):
+        """Chạy trên pool ảnh: ghi tham chiếu ảnh vào access_log qua writer"""
+        for log_id in log_ids:
+            self.log_writer.submit(SnapshotUpdate(log_id, digest))
+    
+    def publish_card_changes(self, upserted=(), removed=()):
+        """Gửi thay đổi danh sách thẻ dạng delta thay vì toàn bộ danh sách"""
+        socketio.emit('cards_changed', {'upserted': list(upserted), 'removed': list(removed)})
     
     def add_card(self, uid, name):
-        uid = uid.strip().upper()
-        name = name.strip()
+        uid = (uid or '').strip().upper()
+        name = (name or '').strip()
         if not uid or not name:
             return False, "Vui lòng nhập đầy đủ UID và tên"
         try:
-            with self.get_db_connection() as conn:
-                cursor = conn.cursor()
-                timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                cursor.execute('INSERT OR REPLACE INTO authorized_cards (uid, name, created_at) VALUES (?, ?, ?)',(uid, name, timestamp))
-                conn.commit()
-            self.authorized_cards.add(uid)
+            entries = self.cards.upsert([{'uid': uid, 'name': name}])
             socketio.emit('log_message', {'message': f'✓ Đã thêm/cập nhật thẻ: {uid} - {name}'})
-            socketio.emit('cards_updated', self.get_authorized_cards())
+            self.publish_card_changes(upserted=entries)
             return True, "Thêm thẻ thành công"
         except Exception as e:
             return False, f"Không thể thêm thẻ: {str(e)}"
 
     def edit_card_name(self, uid, new_name):
-        uid = uid.strip().upper()
-        new_name = new_name.strip()
+        uid = (uid or '').strip().upper()
+        new_name = (new_name or '').strip()
         if not uid or not new_name:
             return False, "UID hoặc tên mới không hợp lệ."
         try:
-            with self.get_db_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("UPDATE authorized_cards SET name = ? WHERE uid = ?", (new_name, uid))
-                conn.commit()
+            entry = self.cards.update(uid, name=new_name)
+            if entry is None:
+                return False, f"Không tìm thấy thẻ {uid}"
             socketio.emit('log_message', {'message': f'✓ Đã cập nhật tên thẻ {uid} thành "{new_name}"'})
-            socketio.emit('cards_updated', self.get_authorized_cards())
+            self.publish_card_changes(upserted=[entry])
             return True, "Cập nhật tên thẻ thành công"
         except Exception as e:
             return False, f"Lỗi khi cập nhật tên thẻ: {str(e)}"
 
+    def set_card_policy(self, uid, group=None, schedule=None):
+        """Gán nhóm và lịch riêng cho thẻ, rỗng nghĩa là bỏ giới hạn"""
+        uid = (uid or '').strip().upper()
+        group = (group or '').strip() or None
+        schedule = (schedule or '').strip() or None
+        if group is not None and group not in self.policy.groups:
+            return False, f"Không có nhóm {group}"
+        try:
+            entry = self.cards.update(uid, group=group, schedule=schedule)
+        except ValueError as e:
+            return False, f"Lịch không hợp lệ: {str(e)}"
+        except Exception as e:
+            return False, f"Lỗi khi cập nhật quyền thẻ: {str(e)}"
+        if entry is None:
+            return False, f"Không tìm thấy thẻ {uid}"
+        self.publish_card_changes(upserted=[entry])
+        return True, "Cập nhật quyền thẻ thành công"
+
     def remove_card(self, uid):
+        uid = (uid or '').strip().upper()
         try:
-            with self.get_db_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute('DELETE FROM authorized_cards WHERE uid = ?', (uid,))
-                conn.commit()
-            self.authorized_cards.discard(uid)
+            if not self.cards.remove(uid):
+                return False, f"Không tìm thấy thẻ {uid}"
             socketio.emit('log_message', {'message': f'✓ Đã xóa thẻ: {uid}'})
-            socketio.emit('cards_updated', self.get_authorized_cards())
+            self.publish_card_changes(removed=[uid])
             return True, "Xóa thẻ thành công"
         except Exception as e:
             return False, f"Không thể xóa thẻ: {str(e)}"
     
+    def import_cards(self, cards):
+        """Nhập hàng loạt thẻ (dict như parse_card_import) trong một transaction và một thông báo.
+
+        Trả về (success, message, số thẻ đã nhập, số dòng bị bỏ qua).
+        """
+        valid = []
+        for card in cards:
+            if not card['uid'] or not card['name']:
+                continue
+            if card.get('group') and card['group'] not in self.policy.groups:
+                continue
+            try:
+                self.policy.validate(card)
+            except ValueError:
+                continue
+            valid.append(card)
+        skipped = len(cards) - len(valid)
+        if not valid:
+            return False, "Không có thẻ hợp lệ để nhập", 0, skipped
+        try:
+            entries = self.cards.upsert(valid)
+        except Exception as e:
+            return False, f"Không thể nhập thẻ: {str(e)}", 0, skipped
+        socketio.emit('log_message', {'message': f'✓ Đã nhập {len(entries)} thẻ'})
+        self.publish_card_changes(upserted=entries)
+        return True, f"Đã nhập {len(entries)} thẻ, bỏ qua {skipped} dòng", len(entries), skipped
+    
     def get_authorized_cards(self):
-        with self.get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT uid, name, created_at FROM authorized_cards ORDER BY created_at DESC')
-            return [{'uid': row[0], 'name': row[1], 'created_at': row[2]} for row in cursor.fetchall()]
+        return self.cards.list()
     
     def get_recent_logs(self, limit=50):
+        """limit log mới nhất (mới trước), lấy từ ring nếu đủ"""
+        logs = self.recent_logs.latest(limit)
+        if logs is None:
+            logs = self.query_logs_before(None, limit)
+        return logs
+    
+    def get_logs_after(self, after_id, limit=100):
+        """Log có id > after_id (cũ trước) để client bắt kịp theo cursor"""
+        logs = self.recent_logs.after(after_id, limit)
+        if logs is None:
+            with self.get_db_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(LOG_SELECT + ' WHERE id > ? ORDER BY id LIMIT ?', (after_id, limit))
+                logs = [dict(zip(LOG_COLUMNS, row)) for row in cursor.fetchall()]
+        return logs
+    
+    def query_logs_before(self, before_id, limit):
+        """Đọc từ DB limit log mới nhất có id < before_id (mới trước)"""
         with self.get_db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('SELECT timestamp, direction, card_uid, status FROM access_log ORDER BY id DESC LIMIT ?',(limit,))
-            return [{'timestamp': row[0], 'direction': row[1], 'card_uid': row[2], 'status': row[3]} for row in cursor.fetchall()]
+            if before_id is None:
+                cursor.execute(LOG_SELECT + ' ORDER BY id DESC LIMIT ?', (limit,))
+            else:
+                cursor.execute(LOG_SELECT + ' WHERE id < ? ORDER BY id DESC LIMIT ?', (before_id, limit))
+            return [dict(zip(LOG_COLUMNS, row)) for row in cursor.fetchall()]
+    
+    def search_logs(self, filters, cursor=None, limit=100):
+        """Tìm access log theo bộ lọc, mới trước, phân trang keyset theo (ts, id).
+
+        cursor là chuỗi "ts:id" của dòng cuối trang trước. Trả về
+        (logs, next_cursor), next_cursor là None khi hết dữ liệu.
+        """
+        where, params = build_log_where(filters)
+        if cursor:
+            cursor_ts, cursor_id = parse_log_cursor(cursor)
+            where += (' AND ' if where else ' WHERE ') + '(ts, id) < (?, ?)'
+            params += [cursor_ts, cursor_id]
+        with self.get_db_connection() as conn:
+            rows = conn.execute(LOG_SELECT + where + ' ORDER BY ts DESC, id DESC LIMIT ?', params + [limit + 1]).fetchall()
+        logs = [dict(zip(LOG_COLUMNS, row)) for row in rows[:limit]]
+        next_cursor = f"{logs[-1]['ts']}:{logs[-1]['id']}" if len(rows) > limit else None
+        return logs, next_cursor
+    
+    def export_logs(self, filters, fmt='csv', chunk_size=5000):
+        """Sinh các khối text của mọi log khớp bộ lọc: file lưu trữ trước, DB sau.
+
+        Mỗi khối DB là một truy vấn ngắn theo keyset id, nên bộ nhớ không
+        phụ thuộc độ lớn khoảng thời gian.
+        """
+        if fmt == 'csv':
+            yield format_log_chunk([dict(zip(LOG_COLUMNS, LOG_COLUMNS))], 'csv')
+        where, params = build_log_where(filters)
+        where += (' AND ' if where else ' WHERE ') + 'id > ?'
+        # Không cho archiver chuyển lô giữa lúc đọc lưu trữ và lúc đọc DB
+        with self.log_archiver.paused():
+            for entries in self.log_archiver.iter_archived(filters, chunk_size):
+                yield format_log_chunk(entries, fmt)
+            after_id = 0
+            while True:
+                with self.get_db_connection() as conn:
+                    rows = conn.execute(LOG_SELECT + where + ' ORDER BY id LIMIT ?', params + [after_id, chunk_size]).fetchall()
+                if not rows:
+                    break
+                yield format_log_chunk([dict(zip(LOG_COLUMNS, row)) for row in rows], fmt)
+                after_id = rows[-1][0]
     
+    def aggregate_logs(self, filters, group_by):
+        """Đếm access log theo nhóm (hour, day, door, direction, status, card_uid)"""
+        where, params = build_log_where(filters)
+        with self.get_db_connection() as conn:
+            expressions = {}
+            if 'hour' in group_by or 'day' in group_by:
+                # Chia nhóm giờ/ngày theo giờ máy với offset của chính từng dòng, nên
+                # dòng ở hai phía lần đổi giờ mùa hè vẫn vào đúng nhóm. Giờ lặp lại
+                # lúc lùi đồng hồ được gộp vào cùng một nhóm theo giờ tường.
+                # Hai truy vấn con để SQLite lấy MIN/MAX thẳng từ index ts
+                first, last = conn.execute('SELECT (SELECT MIN(ts) FROM access_log), (SELECT MAX(ts) FROM access_log)').fetchone()
+                local = local_time_expression(first or 0, last or 0)
+                expressions = {'hour': f'({local} / 3600) * 3600', 'day': f'({local} / 86400) * 86400'}
+            columns = [expressions.get(group, group) for group in group_by]
+            select = ', '.join(f'{column} AS g{i}' for i, column in enumerate(columns))
+            group = ', '.join(f'g{i}' for i in range(len(columns)))
+            rows = conn.execute(f'SELECT {select}, COUNT(*) FROM access_log{where} GROUP BY {group} ORDER BY {group}', params).fetchall()
+        results = []
+        for row in rows:
+            item = {'count': row[-1]}
+            for name, value in zip(group_by, row):
+                if name in expressions and value is not None:
+                    # value là giờ máy tính theo giây, định dạng như giờ UTC để không đổi múi lần nữa
+                    item[name] = datetime.fromtimestamp(value, timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+                else:
+                    item[name] = value
+            results.append(item)
+        return results
+    
+    def get_groups(self):
+        return sorted(self.policy.groups.values(), key=lambda group: group['name'])
+
+    def save_group(self, name, doors, schedule):
+        name = (name or '').strip()
+        schedule = (schedule or '').strip() or None
+        if not name:
+            return False, "Vui lòng nhập tên nhóm"
+        try:
+            compile_schedule(schedule)
+            with self.get_db_connection() as conn:
+                conn.execute('''
+                    INSERT INTO access_groups (name, doors, schedule) VALUES (?, ?, ?)
+                    ON CONFLICT(name) DO UPDATE SET doors = excluded.doors, schedule = excluded.schedule
+                ''', (name, ','.join(doors), schedule))
+                conn.commit()
+        except ValueError as e:
+            return False, f"Lịch không hợp lệ: {str(e)}"
+        except Exception as e:
+            return False, f"Không thể lưu nhóm: {str(e)}"
+        self.policy.set_group(name, doors, schedule)
+        socketio.emit('log_message', {'message': f'✓ Đã lưu nhóm {name}'})
+        return True, "Lưu nhóm thành công"
+
+    def remove_group(self, name):
+        try:
+            with self.get_db_connection() as conn:
+                conn.execute('DELETE FROM access_groups WHERE name = ?', (name,))
+                conn.commit()
+        except Exception as e:
+            return False, f"Không thể xóa nhóm: {str(e)}"
+        self.policy.remove_group(name)
+        socketio.emit('log_message', {'message': f'✓ Đã xóa nhóm {name}, thẻ trong nhóm bị khoá'})
+        return True, "Xóa nhóm thành công"
+
+    def toggle_anti_passback(self):
+        self.policy.anti_passback = not self.policy.anti_passback
+        status_text = "Bật" if self.policy.anti_passback else "Tắt"
+        socketio.emit('log_message', {'message': f'Chế độ chống quay vòng thẻ (anti-passback) đã {status_text}.'})
+        return self.policy.anti_passback
+
+    def collect_metrics(self, out):
+        """Số liệu serial, quyết định quyền và DB cho /metrics"""
+        controllers = list(self.controllers.values())
+        out.family('rfid_serial_reply_seconds', 'histogram', 'Độ trễ từ lúc nhận dòng UID tới lúc gửi xong ALLOW/DENY')
+        for controller in controllers:
+            out.histogram('rfid_serial_reply_seconds', controller.reply_latency.histogram, {'door': controller.name})
+        for name, help_text, value in (
+            ('rfid_serial_lines_total', 'Số dòng serial đã nhận', lambda controller: controller.parser.lines),
+            ('rfid_serial_garbled_lines_total', 'Dòng serial có byte không hợp lệ', lambda controller: controller.parser.garbled_lines),
+            ('rfid_serial_overflows_total', 'Dòng serial quá dài bị bỏ', lambda controller: controller.parser.overflows),
+            ('rfid_serial_invalid_frames_total', 'Khung UID không hợp lệ đã bị từ chối', lambda controller: controller.invalid_frames),
+        ):
+            out.family(name, 'counter', help_text)
+            for controller in controllers:
+                out.sample(name, value(controller), {'door': controller.name})
+        out.family('rfid_controller_connected', 'gauge', 'Controller đang kết nối (1) hay không (0)')
+        for controller in controllers:
+            out.sample('rfid_controller_connected', int(controller.is_connected), {'door': controller.name})
+        out.family('rfid_scans_total', 'counter', 'Số lượt quét thẻ theo cửa và kết quả')
+        for (door, result), count in list(self.scan_counts.items()):
+            out.sample('rfid_scans_total', count, {'door': door or '', 'result': result})
+        out.family('rfid_db_commit_seconds', 'histogram', 'Thời gian mỗi lần commit lô access log')
+        out.histogram('rfid_db_commit_seconds', self.log_writer.commit_latency)
+        out.family('rfid_db_rows_written_total', 'counter', 'Số access log đã ghi vào DB')
+        out.sample('rfid_db_rows_written_total', self.log_writer.rows_written)
+        out.family('rfid_db_write_retries_total', 'counter', 'Số lần thử lại một lô access log bị lỗi ghi')
+        out.sample('rfid_db_write_retries_total', self.log_writer.write_retries)
+        out.family('rfid_db_rows_failed_total', 'counter', 'Access log bị bỏ vì ghi từng dòng vẫn lỗi')
+        out.sample('rfid_db_rows_failed_total', self.log_writer.rows_failed)
+        out.family('rfid_queue_depth', 'gauge', 'Số việc đang chờ trong hàng đợi nền')
+        out.sample('rfid_queue_depth', self.log_writer.queue.qsize(), {'queue': 'log_writer'})
+        # Hàng đợi dispatcher chứa các emit Socket.IO sau khi đã trả lời Arduino
+        out.sample('rfid_queue_depth', self.dispatcher.queue.qsize(), {'queue': 'emit'})
+        out.family('rfid_cards', 'gauge', 'Số thẻ trong danh bạ')
+        out.sample('rfid_cards', len(self.cards))
+        out.family('rfid_logs_archived_total', 'counter', 'Số access log đã chuyển sang file lưu trữ')
+        out.sample('rfid_logs_archived_total', self.log_archiver.rows_archived)
+        out.family('rfid_snapshots_total', 'counter', 'Ảnh sự kiện theo kết quả: lưu, gộp frame, bỏ do quá tải, không có frame, lỗi')
+        for result, value in (('captured', self.snapshots.captured), ('coalesced', self.snapshots.coalesced),
+                              ('dropped', self.snapshots.dropped), ('no_frame', self.snapshots.no_frame),
+                              ('failed', self.snapshots.failed)):
+            out.sample('rfid_snapshots_total', value, {'result': result})
+        out.family('rfid_snapshot_store_bytes', 'gauge', 'Dung lượng kho ảnh sự kiện trên đĩa')
+        out.sample('rfid_snapshot_store_bytes', self.snapshots.store.total_bytes)
+
     def toggle_auto_add_mode(self):
         self.auto_add_mode = not self.auto_add_mode
         status_text = "Bật" if self.auto_add_mode else "Tắt"
         socketio.emit('log_message', {'message': f'Chế độ tự động thêm thẻ đã {status_text}.'})
         return self.auto_add_mode
 
+def collect_webrtc_metrics(out):
+    """Số peer WebRTC và thời gian recv() của từng video track"""
+    peers = list(peer_connections.items())
+    out.family('rfid_peer_connections', 'gauge', 'Số PeerConnection WebRTC đang mở')
+    out.sample('rfid_peer_connections', len(peers))
+    tracks = [(connection_id, sender.track) for connection_id, pc in peers for sender in pc.getSenders()
+              if isinstance(sender.track, OpenCVVideoStreamTrack)]
+    out.family('rfid_track_recv_seconds', 'histogram', 'Thời gian mỗi lần recv() của video track, gồm cả chờ frame')
+    for connection_id, track in tracks:
+        out.histogram('rfid_track_recv_seconds', track.recv_time, {'peer': connection_id})
+    for name, help_text, value in (
+        ('rfid_track_frames_sent_total', 'Số frame đã gửi cho peer', lambda track: track.frames_sent),
+        ('rfid_track_frames_skipped_total', 'Số frame nguồn bị bỏ qua với peer', lambda track: track.frames_skipped),
+        ('rfid_track_frames_static_total', 'Frame nguồn không encode vì cảnh đứng yên', lambda track: track.frames_static),
+    ):
+        out.family(name, 'counter', help_text)
+        for connection_id, track in tracks:
+            out.sample(name, value(track), {'peer': connection_id})
+
 # Initialize RFID system
 rfid_system = RFIDControlSystem()
+capture_hub = CaptureHub()
+webrtc_loop = AsyncLoopThread()
+
+class SocketWorkerPool:
+    """Các tiến trình socket_worker.py giữ kết nối dashboard, tự khởi động lại khi chết.
+    
+    Worker i nghe trên cổng port + i, nhận sự kiện qua MESSAGE_QUEUE và chuyển
+    offer WebRTC về gateway. Mỗi lần tải trang, client được giao cho worker
+    kế tiếp theo vòng tròn nên không cần proxy có sticky session.
+    """
+    
+    def __init__(self, count, port):
+        self.ports = [port + i for i in range(1, count + 1)]
+        self.gateway = f'http://127.0.0.1:{port}'
+        self.script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'socket_worker.py')
+        self.processes = {}
+        self.pages = itertools.count()
+        self.stop_event = threading.Event()
+    
+    def start(self):
+        for port in self.ports:
+            self._spawn(port)
+        threading.Thread(target=self._monitor, name='socket-workers', daemon=True).start()
+        atexit.register(self.stop)
+    
+    def _spawn(self, port):
+        self.processes[port] = subprocess.Popen([sys.executable, self.script, '--port', str(port),
+                                                 '--gateway', self.gateway, '--message-queue', MESSAGE_QUEUE])
+        logger.info(f"Đã khởi động worker Socket.IO trên cổng {port}")
+    
+    def _monitor(self):
+        while not self.stop_event.wait(2.0):
+            for port, process in list(self.processes.items()):
+                if process.poll() is not None and not self.stop_event.is_set():
+                    logger.warning(f"Worker Socket.IO cổng {port} đã dừng (mã {process.returncode}), khởi động lại")
+                    self._spawn(port)
+    
+    def next_port(self):
+        return self.ports[next(self.pages) % len(self.ports)]
+    
+    def stop(self):
+        self.stop_event.set()
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+# Được tạo trong __main__ khi đặt RFID_SOCKET_WORKERS
+socket_workers = None
 
 # --- Flask Routes (Không thay đổi) ---
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_template('index.html', socket_port=socket_workers.next_port() if socket_workers else '')
 
 @app.route('/api/connect', methods=['POST'])
 def connect():
     data = request.json
-    success, message = rfid_system.connect_arduino(data.get('com_port'), int(data.get('baud_rate')))
+    cameras = {'in': data.get('camera_in'), 'out': data.get('camera_out')}
+    success, message = rfid_system.connect_arduino(data.get('com_port'), int(data.get('baud_rate')), data.get('name'), cameras)
     return jsonify({'success': success, 'message': message})
 
 @app.route('/api/disconnect', methods=['POST'])
 def disconnect():
-    rfid_system.disconnect_arduino()
-    return jsonify({'success': True})
+    data = request.get_json(silent=True) or {}
+    success = rfid_system.disconnect_arduino(data.get('com_port'))
+    return jsonify({'success': success})
+
+@app.route('/api/controllers')
+def get_controllers():
+    return jsonify([controller.get_status() for controller in rfid_system.controllers.values()])
 
 @app.route('/api/add_card', methods=['POST'])
 def add_card():
@@ -381,6 +3137,55 @@ def remove_card():
     success, message = rfid_system.remove_card(data.get('uid'))
     return jsonify({'success': success, 'message': message})
 
+@app.route('/api/cards/import', methods=['POST'])
+def import_cards():
+    upload = request.files.get('file')
+    if upload:
+        raw, filename = upload.read(), (upload.filename or '').lower()
+    else:
+        raw, filename = request.get_data(as_text=True), ''
+    fmt = request.args.get('format') or ('json' if filename.endswith('.json') or request.is_json else 'csv')
+    try:
+        # File không phải UTF-8: UnicodeDecodeError cũng là ValueError
+        if isinstance(raw, bytes):
+            raw = raw.decode('utf-8-sig')
+        cards = parse_card_import(raw, fmt)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': f'File không hợp lệ: {str(e)}'}), 400
+    success, message, imported, skipped = run_blocking(rfid_system.import_cards, cards)
+    return jsonify({'success': success, 'message': message, 'imported': imported, 'skipped': skipped})
+
+@app.route('/api/card_policy', methods=['POST'])
+def set_card_policy():
+    data = request.json
+    success, message = rfid_system.set_card_policy(data.get('uid'), data.get('group'), data.get('schedule'))
+    return jsonify({'success': success, 'message': message})
+
+@app.route('/api/groups')
+def get_groups():
+    return jsonify(rfid_system.get_groups())
+
+@app.route('/api/save_group', methods=['POST'])
+def save_group():
+    data = request.json
+    success, message = rfid_system.save_group(data.get('name'), split_doors(data.get('doors')), data.get('schedule'))
+    return jsonify({'success': success, 'message': message})
+
+@app.route('/api/remove_group', methods=['POST'])
+def remove_group():
+    data = request.json
+    success, message = rfid_system.remove_group(data.get('name'))
+    return jsonify({'success': success, 'message': message})
+
+@app.route('/api/toggle_anti_passback', methods=['POST'])
+def toggle_anti_passback():
+    mode = rfid_system.toggle_anti_passback()
+    return jsonify({'anti_passback': mode})
+
+@app.route('/api/policy_stats')
+def get_policy_stats():
+    return jsonify(rfid_system.policy.get_stats())
+
 @app.route('/api/toggle_auto_add', methods=['POST'])
 def toggle_auto_add():
     mode = rfid_system.toggle_auto_add_mode()
@@ -390,17 +3195,167 @@ def toggle_auto_add():
 def get_cards():
     return jsonify(rfid_system.get_authorized_cards())
 
+@app.route('/api/logs/search')
+def search_logs():
+    try:
+        filters = parse_log_filters(request.args)
+        limit = max(1, min(request.args.get('limit', 100, type=int), 1000))
+        cursor = request.args.get('cursor')
+        if cursor:
+            # Kiểm tra ở đây để cursor hỏng trả 400 mà không thành lỗi trên threadpool
+            parse_log_cursor(cursor)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': f'Tham số không hợp lệ: {str(e)}'}), 400
+    logs, next_cursor = run_blocking(rfid_system.search_logs, filters, cursor, limit)
+    # Dòng cũ tới archived_until đã chuyển sang file lưu trữ, chỉ có trong export
+    archived_until = run_blocking(rfid_system.log_archiver.archived_until)
+    return jsonify({'logs': logs, 'next_cursor': next_cursor, 'archived_until': archived_until})
+
+@app.route('/api/logs/stats')
+def get_log_stats():
+    group_by = [group for group in request.args.get('group', 'hour').split(',') if group]
+    if not group_by or any(group not in LOG_GROUPS for group in group_by):
+        return jsonify({'success': False, 'message': f'group phải thuộc: {", ".join(LOG_GROUPS)}'}), 400
+    try:
+        filters = parse_log_filters(request.args)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': f'Tham số không hợp lệ: {str(e)}'}), 400
+    return jsonify(run_blocking(rfid_system.aggregate_logs, filters, group_by))
+
+@app.route('/api/logs/export')
+def export_logs():
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'jsonl'):
+        return jsonify({'success': False, 'message': 'format phải là csv hoặc jsonl'}), 400
+    try:
+        filters = parse_log_filters(request.args)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': f'Tham số không hợp lệ: {str(e)}'}), 400
+    filename = f"access_log-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{fmt}"
+    chunks = rfid_system.export_logs(filters, fmt)
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    if request.args.get('compress', 'gzip') == 'gzip':
+        chunks, mimetype, filename = gzip_stream(chunks), 'application/gzip', filename + '.gz'
+    # Đọc DB/file lưu trữ và nén từng khối trên threadpool, không giữ hub gevent
+    return Response(iter_blocking(chunks), mimetype=mimetype, headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+@app.route('/api/logs/archive')
+def get_log_archive():
+    return jsonify(rfid_system.log_archiver.get_stats())
+
+@app.route('/api/snapshots/<digest>')
+def get_snapshot(digest):
+    if not SNAPSHOT_DIGEST_RE.match(digest):
+        abort(404)
+    path = rfid_system.snapshots.store.path(digest, thumb=request.args.get('thumb') == '1')
+    if not os.path.exists(path):
+        abort(404)
+    # Nội dung không đổi theo digest nên cache lâu được
+    return send_file(os.path.abspath(path), mimetype='image/jpeg', max_age=31536000)
+
+@app.route('/api/snapshot_stats')
+def get_snapshot_stats():
+    return jsonify(rfid_system.snapshots.get_stats())
+
 @app.route('/api/logs')
 def get_logs():
-    return jsonify(rfid_system.get_recent_logs())
+    limit = max(1, min(request.args.get('limit', 50, type=int), 1000))
+    after_id = request.args.get('after_id', type=int)
+    if after_id is None:
+        return jsonify(rfid_system.get_recent_logs(limit))
+    return jsonify(rfid_system.get_logs_after(after_id, limit))
+
+@app.route('/api/serial_stats')
+def get_serial_stats():
+    return jsonify({
+        'controllers': [controller.get_stats() for controller in rfid_system.controllers.values()],
+        'dispatch_queue_depth': rfid_system.dispatcher.queue.qsize(),
+        'blocked_dispatches': rfid_system.dispatcher.blocked_dispatches
+    })
+
+@app.route('/api/db_stats')
+def get_db_stats():
+    return jsonify(rfid_system.log_writer.get_stats())
+
+@app.route('/api/cameras')
+def get_cameras():
+    return jsonify(capture_hub.get_stats())
+
+# Giữ reader thêm một lúc sau mỗi lần lấy latest.jpg để client poll không mở lại camera
+LATEST_JPEG_LINGER = 10.0
+
+def acquire_http_reader(args):
+    """Lấy reader cho client HTTP theo ?url=, None nếu camera không sẵn sàng"""
+    reader = capture_hub.acquire(args['url'])
+    if not run_blocking(reader.ready_event.wait, 10.0):
+        capture_hub.release(reader)
+        return None
+    return reader
+
+@app.route('/api/camera/mjpeg')
+def camera_mjpeg():
+    if not request.args.get('url'):
+        return jsonify({'success': False, 'message': 'Thiếu tham số url'}), 400
+    profile = parse_video_profile(request.args)
+    bounds = profile_bounds(profile)
+    reader = acquire_http_reader(request.args)
+    if reader is None:
+        return jsonify({'success': False, 'message': 'Camera không sẵn sàng sau 10 giây'}), 503
+    stream = MjpegStream(reader, parse_jpeg_quality(request.args.get('quality')), bounds, profile['max_fps'])
+    
+    def close():
+        stream.close()
+        capture_hub.release(reader)
+    
+    response = Response(stream, mimetype=f'multipart/x-mixed-replace; boundary={MjpegStream.BOUNDARY}',
+                        headers={'Cache-Control': 'no-store'})
+    response.call_on_close(close)
+    return response
+
+@app.route('/api/camera/latest.jpg')
+def camera_latest_jpeg():
+    if not request.args.get('url'):
+        return jsonify({'success': False, 'message': 'Thiếu tham số url'}), 400
+    profile = parse_video_profile(request.args)
+    bounds = profile_bounds(profile)
+    reader = acquire_http_reader(request.args)
+    if reader is None:
+        return jsonify({'success': False, 'message': 'Camera không sẵn sàng sau 10 giây'}), 503
+    # Giữ profile thu nhỏ cùng với reader để các lần poll sau có sẵn frame đúng cỡ
+    token = object()
+    if bounds:
+        reader.add_profile(id(token), bounds, profile['max_fps'])
+    
+    def release_reader():
+        if bounds:
+            reader.remove_profile(id(token), bounds)
+        capture_hub.release(reader)
+    
+    try:
+        _, jpeg = run_blocking(reader.jpeg_cache.get, 0, parse_jpeg_quality(request.args.get('quality')), bounds, 5.0)
+    finally:
+        release = threading.Timer(LATEST_JPEG_LINGER, release_reader)
+        release.daemon = True
+        release.start()
+    if jpeg is None:
+        return jsonify({'success': False, 'message': 'Chưa có frame từ camera'}), 503
+    return Response(jpeg, mimetype='image/jpeg', headers={'Cache-Control': 'no-store'})
+
+@app.route('/metrics')
+def metrics():
+    out = PrometheusText()
+    rfid_system.collect_metrics(out)
+    capture_hub.collect_metrics(out)
+    collect_webrtc_metrics(out)
+    return Response(out.render(), mimetype=PrometheusText.CONTENT_TYPE)
 
 @app.route('/api/status')
 def get_status():
     return jsonify({
         'connected': rfid_system.is_connected,
-        'com_port': rfid_system.current_com_port,
-        'baud_rate': rfid_system.current_baud_rate,
-        'auto_add_mode': rfid_system.auto_add_mode
+        'controllers': [controller.get_status() for controller in rfid_system.controllers.values()],
+        'auto_add_mode': rfid_system.auto_add_mode,
+        'anti_passback': rfid_system.policy.anti_passback
     })
 
 # =======================================================
@@ -412,11 +3367,14 @@ async def cleanup_connection(connection_id):
     try:
         if connection_id in camera_readers:
             reader = camera_readers.pop(connection_id)
-            reader.stop()
-            logger.info(f"Đã dừng CameraReader: {connection_id}")
+            capture_hub.release(reader)
+            logger.info(f"Đã trả CameraReader: {connection_id}")
             
         if connection_id in peer_connections:
             pc = peer_connections.pop(connection_id)
+            for sender in pc.getSenders():
+                if sender.track:
+                    sender.track.stop()
             await pc.close()
             logger.info(f"Đã đóng PeerConnection: {connection_id}")
             
@@ -434,78 +3392,96 @@ def handle_offer(data):
     if not all([direction, url, connection_id]):
         logger.error(f"Offer không hợp lệ từ {sid}: {data}")
         return
-
-    logger.info(f"Nhận offer từ {sid} cho {direction}, URL: {url}")
     
-    def run_async_task():
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        try:
-            loop.run_until_complete(handle_offer_async(connection_id, data, sid, direction, url))
-        finally:
-            loop.close()
+    logger.info(f"Nhận offer từ {sid} cho {direction}, URL: {url}")
     
-    threading.Thread(target=run_async_task, daemon=True).start()
+    webrtc_loop.submit(handle_offer_async(connection_id, data, sid, direction, url))
 
 async def handle_offer_async(connection_id, data, sid, direction, url):
-    """Async handler cho WebRTC offer"""
+    """Async handler cho WebRTC offer nhận qua Socket.IO"""
+    try:
+        answer = await create_answer(connection_id, data, direction, url)
+        # Gửi answer về client
+        socketio.emit('answer', answer, room=sid)
+        logger.info(f"Đã gửi answer cho {connection_id}")
+    except Exception as e:
+        logger.error(f"Lỗi trong handle_offer_async cho {connection_id}: {e}", exc_info=True)
+        socketio.emit('error', {'message': f'Lỗi thiết lập WebRTC: {str(e)}'}, room=sid)
+
+async def create_answer(connection_id, data, direction, url):
+    """Tạo PeerConnection cho offer và trả về answer; lỗi thì dọn dẹp rồi raise"""
     try:
         # Dọn dẹp kết nối cũ trước khi tạo mới
         await cleanup_connection(connection_id)
-        
-        loop = asyncio.get_running_loop()
-        camera_ready_event = asyncio.Event()
-        
-        # Tạo và khởi động camera reader
-        camera_reader = CameraReader(url, direction, loop, camera_ready_event)
+    
+        # Lấy camera reader dùng chung cho URL này
+        camera_reader = capture_hub.acquire(url, direction)
         camera_readers[connection_id] = camera_reader
-        camera_reader.start()
-
+    
         # Đợi camera sẵn sàng hoặc timeout sau 10 giây
         logger.info(f"[{connection_id}] Đang đợi camera sẵn sàng...")
-        try:
-            await asyncio.wait_for(camera_ready_event.wait(), timeout=10.0)
-        except asyncio.TimeoutError:
-            logger.error(f"[{connection_id}] Camera không sẵn sàng sau 10 giây.")
-            await cleanup_connection(connection_id)
-            return
-
+        ready = await asyncio.to_thread(camera_reader.ready_event.wait, 10.0)
+        if not ready:
+            raise RuntimeError('Camera không sẵn sàng sau 10 giây')
+    
         logger.info(f"[{connection_id}] Camera đã sẵn sàng. Bắt đầu thiết lập WebRTC.")
-        
+    
         # Tạo peer connection
         pc = RTCPeerConnection()
         peer_connections[connection_id] = pc
-        
+    
         @pc.on("connectionstatechange")
         async def on_connectionstatechange():
             logger.info(f"[{connection_id}] Trạng thái kết nối: {pc.connectionState}")
             if pc.connectionState in ["failed", "closed", "disconnected"]:
                 await cleanup_connection(connection_id)
-        
+    
         # Thêm video track
-        video_track = OpenCVVideoStreamTrack(camera_reader)
+        video_track = OpenCVVideoStreamTrack(camera_reader, **parse_video_profile(data))
         pc.addTrack(video_track)
-        
+    
         # Xử lý offer và tạo answer
         offer = RTCSessionDescription(sdp=data['sdp'], type=data['type'])
         await pc.setRemoteDescription(offer)
-        
+    
         answer = await pc.createAnswer()
         await pc.setLocalDescription(answer)
-        
-        # Gửi answer về client
-        socketio.emit('answer', {
+    
+        return {
             'sdp': pc.localDescription.sdp,
             'type': pc.localDescription.type,
             'direction': direction
-        }, room=sid)
-        
-        logger.info(f"Đã gửi answer cho {connection_id}")
-        
-    except Exception as e:
-        logger.error(f"Lỗi trong handle_offer_async cho {connection_id}: {e}", exc_info=True)
-        socketio.emit('error', {'message': f'Lỗi thiết lập WebRTC: {str(e)}'}, room=sid)
+        }
+    
+    except Exception:
         await cleanup_connection(connection_id)
+        raise
+
+@app.route('/api/webrtc/offer', methods=['POST'])
+def webrtc_offer():
+    """Signaling qua HTTP cho worker Socket.IO (và client không dùng Socket.IO)"""
+    data = request.get_json(silent=True) or {}
+    client_id, direction, url = data.get('client_id'), data.get('direction'), data.get('url')
+    if not all([client_id, direction, url, data.get('sdp'), data.get('type')]):
+        return jsonify({'success': False, 'message': 'Cần client_id, direction, url, sdp và type'}), 400
+    connection_id = f"{client_id}_{direction}"
+    logger.info(f"Nhận offer HTTP từ {client_id} cho {direction}, URL: {url}")
+    future = webrtc_loop.submit(create_answer(connection_id, data, direction, url))
+    try:
+        return jsonify(run_blocking(future.result, 30))
+    except Exception as e:
+        logger.error(f"Lỗi thiết lập WebRTC cho {connection_id}: {e}")
+        return jsonify({'success': False, 'message': f'Lỗi thiết lập WebRTC: {str(e)}'}), 500
+
+@app.route('/api/webrtc/close', methods=['POST'])
+def webrtc_close():
+    data = request.get_json(silent=True) or {}
+    client_id = data.get('client_id')
+    if not client_id:
+        return jsonify({'success': False, 'message': 'Thiếu client_id'}), 400
+    for direction in ('in', 'out'):
+        webrtc_loop.submit(cleanup_connection(f"{client_id}_{direction}"))
+    return jsonify({'success': True})
 
 
 @socketio.on('disconnect')
@@ -514,16 +3490,8 @@ def handle_disconnect():
     sid = request.sid
     logger.info(f"Client ngắt kết nối: {sid}")
     
-    def cleanup_all():
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        try:
-            loop.run_until_complete(cleanup_connection(f"{sid}_in"))
-            loop.run_until_complete(cleanup_connection(f"{sid}_out"))
-        finally:
-            loop.close()
-    
-    threading.Thread(target=cleanup_all, daemon=True).start()
+    webrtc_loop.submit(cleanup_connection(f"{sid}_in"))
+    webrtc_loop.submit(cleanup_connection(f"{sid}_out"))
 
 if __name__ == '__main__':
     if not os.path.exists('templates'):
@@ -534,5 +3502,19 @@ if __name__ == '__main__':
         import shutil
         shutil.copy('index.html', 'templates/index.html')
 
-    logger.info("Khởi động server...")
-    socketio.run(app, debug=False, host='0.0.0.0', port=5000, allow_unsafe_werkzeug=True)
\ No newline at end of file
+    if SOCKET_WORKERS:
+        if not MESSAGE_QUEUE:
+            logger.error("RFID_SOCKET_WORKERS cần RFID_MESSAGE_QUEUE để worker nhận sự kiện")
+            sys.exit(1)
+        socket_workers = SocketWorkerPool(SOCKET_WORKERS, SERVER_PORT)
+        socket_workers.start()
+    
+    # SIGTERM (systemd, docker stop) dừng server êm để atexit ghi hết log và dừng worker
+    if ASYNC_MODE == 'gevent':
+        # Handler chạy trong greenlet riêng; serve_forever() trả về sau khi server dừng
+        gevent.signal_handler(signal.SIGTERM, socketio.stop)
+    else:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    
+    logger.info(f"Khởi động server ({ASYNC_MODE})...")
+    socketio.run(app, debug=False, host='0.0.0.0', port=SERVER_PORT, allow_unsafe_werkzeug=True)
\ No newline at end of file
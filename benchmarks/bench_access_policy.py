@@ -0,0 +1,91 @@
+"""Benchmark độ trễ quyết định của AccessPolicy với số thẻ lớn.
+
+Nạp N thẻ chia vào các nhóm cửa/khung giờ (một phần có lịch riêng), bật
+anti-passback rồi quét thẻ ngẫu nhiên theo nhịp cố định (mặc định 100 lượt/s)
+và đo độ trễ của decide(), sau đó đo thông lượng khi quét liên tục.
+
+Chạy: python benchmarks/bench_access_policy.py --cards 1000000 --rate 100 --seconds 10
+"""
+
+import argparse
+import random
+import resource
+import time
+
+from load_app import app
+
+SCHEDULES = ['mon-fri 07:00-19:00', 'mon-sat 06:00-22:00', '*', 'sat,sun 08:00-12:00', 'daily 22:00-06:00']
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def build_policy(cards, groups, doors, rng):
+    policy = app.AccessPolicy()
+    door_names = [f'door-{i}' for i in range(doors)]
+    for i in range(groups):
+        policy.set_group(f'group-{i}', rng.sample(door_names, rng.randint(1, doors)), rng.choice(SCHEDULES))
+    chunk = 100000
+    for offset in range(0, cards, chunk):
+        policy.set_cards({
+            'uid': f'{i:08X}',
+            'group': f'group-{rng.randrange(groups)}' if rng.random() < 0.9 else None,
+            'schedule': rng.choice(SCHEDULES) if rng.random() < 0.1 else None,
+        } for i in range(offset, min(cards, offset + chunk)))
+    return policy, door_names
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cards', type=int, default=1_000_000)
+    parser.add_argument('--groups', type=int, default=50)
+    parser.add_argument('--doors', type=int, default=20)
+    parser.add_argument('--rate', type=float, default=100, help='lượt quét/giây')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--unknown', type=float, default=0.05, help='tỉ lệ thẻ chưa đăng ký')
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    start = time.perf_counter()
+    policy, door_names = build_policy(args.cards, args.groups, args.doors, rng)
+    policy.anti_passback = True
+    rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"Nạp {args.cards:,} thẻ: {time.perf_counter() - start:.1f}s, "
+          f"{len(policy.rules)} rule, RSS tối đa {rss_mb:.0f} MB")
+
+    def scan():
+        if rng.random() < args.unknown:
+            uid = f'X{rng.randrange(args.cards):07X}'
+        else:
+            uid = f'{rng.randrange(args.cards):08X}'
+        return uid, rng.choice(('IN', 'OUT')), rng.choice(door_names)
+
+    latencies, allowed = [], 0
+    interval = 1 / args.rate
+    deadline = time.perf_counter()
+    for _ in range(int(args.rate * args.seconds)):
+        deadline += interval
+        uid, direction, door = scan()
+        begin = time.perf_counter()
+        ok, _ = policy.decide(uid, direction, door)
+        latencies.append(time.perf_counter() - begin)
+        allowed += ok
+        delay = deadline - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    latencies.sort()
+    print(f"{len(latencies)} lượt ở {args.rate:g}/s: cho phép {allowed / len(latencies):.0%}, "
+          f"p50 {percentile(latencies, 0.5) * 1e6:.1f}µs, p99 {percentile(latencies, 0.99) * 1e6:.1f}µs, "
+          f"max {latencies[-1] * 1e6:.1f}µs")
+
+    scans = [scan() for _ in range(200000)]
+    begin = time.perf_counter()
+    for uid, direction, door in scans:
+        policy.decide(uid, direction, door)
+    elapsed = time.perf_counter() - begin
+    print(f"Quét liên tục: {len(scans) / elapsed:,.0f} quyết định/s ({elapsed / len(scans) * 1e6:.2f}µs/lượt)")
+
+
+if __name__ == '__main__':
+    main()
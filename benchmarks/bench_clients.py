@@ -0,0 +1,151 @@
+"""Sức chứa client Socket.IO: threading so với gevent và gevent + worker Socket.IO.
+
+Mỗi cấu hình chạy app.py trong tiến trình con với DB tạm, rồi tăng dần số
+client Socket.IO (socketio.AsyncClient, chung một event loop) theo từng bậc.
+Client lấy cổng Socket.IO từ trang chủ như trình duyệt (có worker thì mỗi
+trang được giao một worker). Ở mỗi bậc: số client kết nối được, rồi phát
+vài sự kiện broadcast (bật/tắt tự thêm thẻ -> log_message tới mọi dashboard)
+và đo độ trễ tới từng client, cùng số thread và RSS của server + worker.
+Sức chứa = bậc lớn nhất mà mọi client kết nối được, nhận đủ sự kiện và p99
+dưới --max-p99.
+
+Cấu hình: threading | gevent | gevent+N (N worker, cần --message-queue).
+
+Chạy: python benchmarks/bench_clients.py --modes threading,gevent,gevent+2 --steps 100,250,500,1000 --message-queue redis://127.0.0.1:6379/0
+"""
+
+import argparse
+import asyncio
+import tempfile
+import time
+
+import aiohttp
+import socketio
+
+from bench_load import SOCKET_PORT_RE, Server, percentile
+
+
+def mode_env(mode, message_queue):
+    async_mode, _, workers = mode.partition('+')
+    env = {'RFID_ASYNC_MODE': async_mode}
+    if workers:
+        if not message_queue:
+            raise SystemExit(f'{mode} cần --message-queue')
+        env.update(RFID_SOCKET_WORKERS=workers, RFID_MESSAGE_QUEUE=message_queue)
+    return env
+
+
+class Dashboards:
+    """Các client Socket.IO ghi lại thời điểm nhận log_message"""
+
+    def __init__(self, base_url, batch):
+        self.base_url = base_url
+        self.batch = batch
+        self.clients = []
+        self.received = {}
+        self.failed = 0
+
+    async def socket_url(self, session):
+        async with session.get(self.base_url + '/') as response:
+            port = SOCKET_PORT_RE.search(await response.text()).group(1)
+        return f'http://127.0.0.1:{port}' if port else self.base_url
+
+    async def connect_one(self, session):
+        client = socketio.AsyncClient(reconnection=False)
+        client.on('log_message', lambda data, client=client: self.received.setdefault(client, time.perf_counter()))
+        try:
+            await client.connect(await self.socket_url(session), wait_timeout=20)
+        except Exception:
+            self.failed += 1
+            return
+        self.clients.append(client)
+
+    async def grow(self, target):
+        async with aiohttp.ClientSession() as session:
+            while len(self.clients) + self.failed < target:
+                count = min(self.batch, target - len(self.clients) - self.failed)
+                await asyncio.gather(*(self.connect_one(session) for _ in range(count)))
+
+    async def broadcast(self, server, rounds, timeout):
+        """Độ trễ (giây) tới từng client cho mỗi lượt broadcast, và số lần nhận thiếu"""
+        latencies, missing = [], 0
+        for _ in range(rounds):
+            self.received.clear()
+            started = time.perf_counter()
+            await asyncio.to_thread(server.post, '/api/toggle_auto_add', {})
+            deadline = started + timeout
+            while len(self.received) < len(self.clients) and time.perf_counter() < deadline:
+                await asyncio.sleep(0.01)
+            latencies.extend(received - started for received in self.received.values())
+            missing += len(self.clients) - len(self.received)
+            await asyncio.sleep(0.2)
+        return latencies, missing
+
+    async def close(self):
+        await asyncio.gather(*(client.disconnect() for client in self.clients), return_exceptions=True)
+
+
+async def run_mode(mode, args, port):
+    server = Server(port, tempfile.mkdtemp(), mode_env(mode, args.message_queue))
+    results = []
+    dashboards = Dashboards(server.base_url, args.batch)
+    try:
+        await asyncio.to_thread(server.wait_ready)
+        if server.process.poll() is not None:
+            raise RuntimeError(f'app.py đã thoát (cổng {port} đang bận?), xem server.log')
+        # Chờ worker Socket.IO (nếu có) mở cổng
+        await asyncio.sleep(3)
+        for step in args.steps:
+            started = time.monotonic()
+            await dashboards.grow(step)
+            connect_s = time.monotonic() - started
+            latencies, missing = await dashboards.broadcast(server, args.rounds, args.timeout)
+            threads, rss = server.process_stats()
+            result = {
+                'mode': mode,
+                'clients': step,
+                'connected': len(dashboards.clients),
+                'connect_s': connect_s,
+                'missing': missing,
+                'p50_ms': percentile(latencies, 0.5) * 1000,
+                'p99_ms': percentile(latencies, 0.99) * 1000,
+                'threads': threads,
+                'rss_mb': rss,
+            }
+            result['ok'] = (result['connected'] == step and not missing and result['p99_ms'] <= args.max_p99)
+            results.append(result)
+            print(f"{mode:<12} {step:6d} client: kết nối {result['connected']:6d} ({connect_s:5.1f}s)  "
+                  f"thiếu {missing:5d}  p50 {result['p50_ms']:8.1f}ms  p99 {result['p99_ms']:8.1f}ms  "
+                  f"{threads:5d} thread  {rss:7.1f} MB  {'OK' if result['ok'] else 'QUÁ TẢI'}", flush=True)
+            if not result['ok']:
+                break
+    finally:
+        await dashboards.close()
+        server.stop()
+    passed = [result['clients'] for result in results if result['ok']]
+    return max(passed) if passed else 0
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modes', default='threading,gevent')
+    parser.add_argument('--steps', default='100,250,500,1000')
+    parser.add_argument('--rounds', type=int, default=5, help='số lượt broadcast mỗi bậc')
+    parser.add_argument('--timeout', type=float, default=10.0, help='thời gian chờ mỗi lượt broadcast')
+    parser.add_argument('--max-p99', type=float, default=1000.0, help='ngưỡng p99 (ms) coi là còn chịu được')
+    parser.add_argument('--batch', type=int, default=50, help='số client kết nối đồng thời')
+    parser.add_argument('--message-queue', help='URL message queue cho cấu hình gevent+N')
+    parser.add_argument('--port', type=int, default=5078)
+    args = parser.parse_args()
+    args.steps = [int(step) for step in args.steps.split(',')]
+
+    capacity = {}
+    for mode in args.modes.split(','):
+        capacity[mode] = await run_mode(mode, args, args.port)
+    print('Sức chứa (client nhận đủ sự kiện, p99 <= %.0fms):' % args.max_p99)
+    for mode, clients in capacity.items():
+        print(f"  {mode:<12} {clients}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,99 @@
+"""Microbenchmark: chuyển frame từ CameraReader sang consumer.
+
+So sánh đường cũ (copy khi ghi dưới lock + copy cho mỗi consumer) với
+FrameRing (decode thẳng vào buffer cấp sẵn, consumer lấy view read-only).
+Bước "decode" được giả lập bằng np.copyto từ một frame nguồn, giống nhau ở
+cả hai đường, nên chênh lệch chỉ đến từ việc chuyển frame.
+
+Chạy: python benchmarks/bench_frame_handoff.py --width 1920 --height 1080
+"""
+
+import argparse
+import threading
+import time
+
+import numpy as np
+
+from load_app import app
+
+
+class CopyTwiceReader:
+    """Đường cũ: latest_frame = frame.copy() dưới lock, get_frame() copy lần nữa"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latest_frame = None
+
+    def write(self, source):
+        frame = np.empty_like(source)
+        np.copyto(frame, source)  # decode
+        with self.lock:
+            self.latest_frame = frame.copy()
+
+    def read(self):
+        with self.lock:
+            return self.latest_frame.copy()
+
+
+class RingReader:
+    def __init__(self):
+        self.ring = app.FrameRing()
+
+    def write(self, source):
+        frame = self.ring.write_buffer()
+        if frame is None:
+            frame = np.empty_like(source)
+        np.copyto(frame, source)  # decode
+        self.ring.publish(frame)
+
+    def read(self):
+        return self.ring.read()[1]
+
+
+def run(reader, source, frames, consumers):
+    write_time = 0.0
+    read_times = []
+    for _ in range(frames):
+        start = time.perf_counter()
+        reader.write(source)
+        write_time += time.perf_counter() - start
+        for _ in range(consumers):
+            start = time.perf_counter()
+            reader.read()
+            read_times.append(time.perf_counter() - start)
+    read_times.sort()
+    total = write_time + sum(read_times)
+    return {
+        'write_us': write_time / frames * 1e6,
+        'read_p50_us': read_times[len(read_times) // 2] * 1e6,
+        'read_p99_us': read_times[int(len(read_times) * 0.99)] * 1e6,
+        'frame_ms': total / frames * 1e3,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--fps', type=int, default=30)
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--consumers', type=int, nargs='+', default=[1, 4, 10])
+    args = parser.parse_args()
+
+    source = np.random.randint(0, 255, (args.height, args.width, 3), dtype=np.uint8)
+    frame_bytes = source.nbytes
+    print(f"Frame {args.width}x{args.height} BGR = {frame_bytes / 1e6:.1f} MB, {args.fps} fps")
+    print(f"{'đường':<10} {'consumer':>8} {'ghi us':>9} {'đọc p50 us':>11} {'đọc p99 us':>11} "
+          f"{'ms/frame':>9} {'copy MB/s':>10}")
+    for consumers in args.consumers:
+        for name, reader, copies in (('copy x2', CopyTwiceReader(), 1 + consumers),
+                                     ('ring', RingReader(), 0)):
+            result = run(reader, source, args.frames, consumers)
+            # Băng thông memcpy thêm ngoài decode, ở tốc độ camera
+            bandwidth = frame_bytes * copies * args.fps / 1e6
+            print(f"{name:<10} {consumers:>8} {result['write_us']:>9.0f} {result['read_p50_us']:>11.1f} "
+                  f"{result['read_p99_us']:>11.1f} {result['frame_ms']:>9.2f} {bandwidth:>10.0f}")
+
+
+if __name__ == '__main__':
+    main()
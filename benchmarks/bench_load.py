@@ -0,0 +1,343 @@
+"""Load test toàn hệ thống không cần phần cứng: N controller, M người xem, K dashboard.
+
+Chạy app.py trong tiến trình con với DB tạm rồi tăng tải theo từng giai
+đoạn (nền -> controller -> dashboard -> video). Controller là FakeArduino
+trên pty (simulator.py), người xem là client WebRTC (aiortc) xem nguồn
+"synthetic:...", dashboard là client Socket.IO nhận sự kiện như giao diện.
+Mỗi giai đoạn báo: CPU của server, độ trễ khứ hồi quét thẻ p50/p99 đo ở
+Arduino giả, số dòng access_log ghi mỗi giây và số sự kiện dashboard nhận.
+CPU cho mỗi luồng video = CPU tăng thêm ở giai đoạn video / M. Với
+--mjpeg-viewers có thêm giai đoạn người xem MJPEG qua HTTP (/api/camera/mjpeg)
+trước giai đoạn WebRTC để so sánh CPU mỗi luồng của hai chế độ. Nguồn có
+đoạn đứng yên (--camera synthetic:640x480@30:0.2) cho thấy phần encode tiết
+kiệm được khi video track hạ về frame giữ kết nối lúc cảnh tĩnh.
+
+Cần Linux (pty, /proc) và python-socketio[client] cho dashboard/signaling.
+
+Chạy: python benchmarks/bench_load.py --controllers 4 --rate 5 --viewers 4 --dashboards 10 --seconds 15
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+import socketio
+from aiortc import RTCPeerConnection, RTCSessionDescription
+
+from simulator import FakeArduino, make_uids
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOCKET_PORT_RE = re.compile(r"const SOCKET_PORT = '(\d*)'")
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Server:
+    """app.py trong tiến trình con, đo CPU qua /proc. Chế độ server lấy từ biến môi trường RFID_*"""
+
+    def __init__(self, port, workdir, env=None):
+        self.base_url = f'http://127.0.0.1:{port}'
+        self.log = open(os.path.join(workdir, 'server.log'), 'w')
+        env = dict(os.environ, PYTHONPATH=ROOT, RFID_PORT=str(port), **(env or {}))
+        self.process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'app.py')],
+                                        cwd=workdir, env=env, stdout=self.log, stderr=subprocess.STDOUT)
+        self.clock_ticks = os.sysconf('SC_CLK_TCK')
+
+    def wait_ready(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                return self.get('/api/status')
+            except OSError:
+                time.sleep(0.2)
+        raise RuntimeError('Server không khởi động được, xem server.log')
+
+    def get(self, path):
+        with urllib.request.urlopen(self.base_url + path, timeout=10) as response:
+            return json.load(response)
+
+    def post(self, path, data):
+        request = urllib.request.Request(self.base_url + path, json.dumps(data).encode(),
+                                         {'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return json.load(response)
+
+    def cpu_seconds(self):
+        with open(f'/proc/{self.process.pid}/stat') as stat:
+            fields = stat.read().rsplit(')', 1)[1].split()
+        # utime, stime là trường 14, 15 (tính cả tên tiến trình)
+        return (int(fields[11]) + int(fields[12])) / self.clock_ticks
+
+    def pids(self):
+        """pid của server và các tiến trình con (worker Socket.IO)"""
+        pids = [self.process.pid]
+        for pid in pids:
+            try:
+                with open(f'/proc/{pid}/task/{pid}/children') as children:
+                    pids.extend(int(child) for child in children.read().split())
+            except OSError:
+                pass
+        return pids
+
+    def process_stats(self):
+        """Tổng số thread và RSS (MB) của server cùng các worker"""
+        threads = rss = 0
+        for pid in self.pids():
+            try:
+                with open(f'/proc/{pid}/status') as status:
+                    for line in status:
+                        if line.startswith('Threads:'):
+                            threads += int(line.split()[1])
+                        elif line.startswith('VmRSS:'):
+                            rss += int(line.split()[1]) / 1024
+            except OSError:
+                pass
+        return threads, rss
+
+    def stop(self):
+        children = self.pids()[1:]
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        # Worker còn sót nếu server bị kill
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        self.log.close()
+
+
+def socket_url(base_url):
+    """URL Socket.IO trang chủ giao cho client: worker Socket.IO nếu có, không thì chính server"""
+    with urllib.request.urlopen(base_url + '/', timeout=10) as response:
+        port = SOCKET_PORT_RE.search(response.read().decode()).group(1)
+    return f'http://127.0.0.1:{port}' if port else base_url
+
+
+class Dashboard:
+    """Client Socket.IO đếm sự kiện như giao diện web"""
+
+    EVENTS = ('logs_added', 'access_granted', 'access_denied', 'log_message')
+
+    def __init__(self, base_url):
+        self.events = 0
+        self.client = socketio.Client()
+        for event in self.EVENTS:
+            self.client.on(event, self.on_event)
+        self.client.connect(socket_url(base_url))
+
+    def on_event(self, data=None):
+        self.events += 1
+
+    def stop(self):
+        self.client.disconnect()
+
+
+class Viewers:
+    """M client WebRTC, mỗi client có socket riêng để signaling như trình duyệt"""
+
+    def __init__(self, base_url, count, camera_url, max_width):
+        self.base_url = base_url
+        self.count = count
+        self.camera_url = camera_url
+        self.max_width = max_width
+        self.frames = 0
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.peers = []
+        self.clients = []
+
+    def start(self):
+        asyncio.run_coroutine_threadsafe(self._start_all(), self.loop).result(timeout=60)
+
+    async def _start_all(self):
+        await asyncio.gather(*(self._start_one() for _ in range(self.count)))
+
+    async def _start_one(self):
+        answer = self.loop.create_future()
+        client = socketio.Client()
+        client.on('answer', lambda data: self.loop.call_soon_threadsafe(answer.set_result, data))
+        await asyncio.to_thread(client.connect, socket_url(self.base_url))
+        self.clients.append(client)
+
+        pc = RTCPeerConnection()
+        pc.addTransceiver('video', direction='recvonly')
+        self.peers.append(pc)
+
+        @pc.on('track')
+        def on_track(track):
+            asyncio.ensure_future(self._pull(track))
+
+        await pc.setLocalDescription(await pc.createOffer())
+        client.emit('offer', {'sdp': pc.localDescription.sdp, 'type': 'offer', 'direction': 'in',
+                              'url': self.camera_url, 'max_width': self.max_width})
+        data = await asyncio.wait_for(answer, 30)
+        await pc.setRemoteDescription(RTCSessionDescription(sdp=data['sdp'], type=data['type']))
+
+    async def _pull(self, track):
+        while True:
+            try:
+                await track.recv()
+            except Exception:
+                break
+            self.frames += 1
+
+    def stop(self):
+        async def close_all():
+            await asyncio.gather(*(pc.close() for pc in self.peers))
+        asyncio.run_coroutine_threadsafe(close_all(), self.loop).result(timeout=30)
+        for client in self.clients:
+            client.disconnect()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class MjpegViewers:
+    """N client đọc /api/camera/mjpeg, đếm frame theo boundary"""
+
+    def __init__(self, base_url, count, camera_url, max_width):
+        query = urllib.parse.urlencode({'url': camera_url, 'max_width': max_width})
+        self.url = f'{base_url}/api/camera/mjpeg?{query}'
+        self.frames = 0
+        self.is_running = True
+        self.threads = [threading.Thread(target=self._pull, daemon=True) for _ in range(count)]
+        for thread in self.threads:
+            thread.start()
+
+    def _pull(self):
+        with urllib.request.urlopen(self.url, timeout=30) as response:
+            while self.is_running:
+                chunk = response.read(65536)
+                if not chunk:
+                    break
+                self.frames += chunk.count(b'--frame\r\n')
+
+    def stop(self):
+        self.is_running = False
+        for thread in self.threads:
+            thread.join(timeout=10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--controllers', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=5, help='lượt quét/giây của mỗi controller')
+    parser.add_argument('--viewers', type=int, default=4)
+    parser.add_argument('--mjpeg-viewers', type=int, default=0, help='người xem MJPEG qua HTTP')
+    parser.add_argument('--dashboards', type=int, default=10)
+    parser.add_argument('--seconds', type=float, default=15, help='thời gian mỗi giai đoạn')
+    parser.add_argument('--camera', default='synthetic:640x480@30')
+    parser.add_argument('--max-width', type=int, default=0, help='profile người xem, 0 = kích thước gốc')
+    parser.add_argument('--cards', type=int, default=1000)
+    parser.add_argument('--port', type=int, default=5077)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    server = Server(args.port, workdir)
+    server.wait_ready()
+    uids = make_uids(args.cards)
+    # 90% thẻ được phép
+    allowed = uids[:int(len(uids) * 0.9)]
+    server.post('/api/cards/import', [{'uid': uid, 'name': f'Thẻ {uid}'} for uid in allowed])
+
+    arduinos, dashboards, viewers, mjpeg = [], [], None, None
+    results = []
+
+    def measure(name):
+        for arduino in arduinos:
+            arduino.latencies.clear()
+        events_before = sum(dashboard.events for dashboard in dashboards)
+        frames_before = viewers.frames if viewers else 0
+        mjpeg_before = mjpeg.frames if mjpeg else 0
+        rows_before = server.get('/api/db_stats')['rows_written']
+        cpu_before, start = server.cpu_seconds(), time.monotonic()
+        time.sleep(args.seconds)
+        elapsed = time.monotonic() - start
+        cpu = (server.cpu_seconds() - cpu_before) / elapsed
+        latencies = [value for arduino in arduinos for value in arduino.latencies]
+        result = {
+            'phase': name,
+            'cpu': cpu,
+            'scans_per_s': len(latencies) / elapsed,
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'db_rows_per_s': (server.get('/api/db_stats')['rows_written'] - rows_before) / elapsed,
+            'events_per_s': (sum(dashboard.events for dashboard in dashboards) - events_before) / elapsed,
+            'fps_per_viewer': ((viewers.frames - frames_before) / elapsed / args.viewers) if viewers else 0,
+            'mjpeg_fps_per_viewer': ((mjpeg.frames - mjpeg_before) / elapsed / args.mjpeg_viewers) if mjpeg else 0,
+        }
+        results.append(result)
+        print(f"{name:<12} CPU {result['cpu']:6.1%}  quét {result['scans_per_s']:6.1f}/s  "
+              f"p50 {result['p50_ms']:6.2f}ms  p99 {result['p99_ms']:6.2f}ms  "
+              f"DB {result['db_rows_per_s']:6.1f} dòng/s  dashboard {result['events_per_s']:7.1f} sự kiện/s  "
+              f"video {result['fps_per_viewer']:5.1f} fps/người  mjpeg {result['mjpeg_fps_per_viewer']:5.1f} fps/người")
+        return result
+
+    try:
+        measure('nền')
+
+        for i in range(args.controllers):
+            arduino = FakeArduino(uids, args.rate, seed=i)
+            arduinos.append(arduino)
+            response = server.post('/api/connect', {'com_port': arduino.port, 'baud_rate': 115200, 'name': f'door-{i}'})
+            if not response['success']:
+                raise RuntimeError(response['message'])
+            arduino.start()
+        measure(f'+{args.controllers} controller')
+
+        dashboards = [Dashboard(server.base_url) for _ in range(args.dashboards)]
+        before_video = measure(f'+{args.dashboards} dashboard')
+
+        if args.mjpeg_viewers:
+            mjpeg = MjpegViewers(server.base_url, args.mjpeg_viewers, args.camera, args.max_width)
+            time.sleep(3)
+            with_mjpeg = measure(f'+{args.mjpeg_viewers} mjpeg')
+            print(f"CPU cho mỗi luồng MJPEG: {(with_mjpeg['cpu'] - before_video['cpu']) / args.mjpeg_viewers:.1%} của một core")
+            before_video = with_mjpeg
+
+        if args.viewers:
+            viewers = Viewers(server.base_url, args.viewers, args.camera, args.max_width)
+            viewers.start()
+            # Bỏ qua giai đoạn khởi động ICE/encoder
+            time.sleep(3)
+            with_video = measure(f'+{args.viewers} video')
+            print(f"CPU cho mỗi luồng video: {(with_video['cpu'] - before_video['cpu']) / args.viewers:.1%} của một core")
+
+        stats = server.get('/api/serial_stats')
+        for controller in stats['controllers']:
+            print(f"{controller['name']}: server trả lời p50 {controller['reply_latency']['p50_ms']}ms "
+                  f"p99 {controller['reply_latency']['p99_ms']}ms")
+        print(f"Kết quả Arduino giả: {[arduino.replies for arduino in arduinos]}")
+    finally:
+        if viewers:
+            viewers.stop()
+        if mjpeg:
+            mjpeg.stop()
+        for dashboard in dashboards:
+            dashboard.stop()
+        for arduino in arduinos:
+            arduino.stop()
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""Benchmark truy vấn access_log trước/sau khi có cột ts và index.
+
+Tạo một DB theo schema cũ (timestamp TEXT, không index) với N dòng tổng hợp,
+đo các truy vấn thường gặp, chạy migrate_access_log() rồi đo lại qua
+search_logs()/aggregate_logs().
+
+Chạy: python benchmarks/bench_log_query.py --rows 10000000
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+from load_app import app
+
+
+def build_legacy_db(path, rows, cards, doors, days):
+    """DB theo schema trước migration: chưa có ts, chưa có index"""
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=OFF')
+    conn.execute('''
+        CREATE TABLE access_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TEXT,
+            direction TEXT,
+            card_uid TEXT,
+            status TEXT,
+            door TEXT
+        )
+    ''')
+    rng = random.Random(1)
+    start = datetime.now() - timedelta(days=days)
+    step = days * 86400 / rows
+    chunk = 100000
+    for offset in range(0, rows, chunk):
+        batch = []
+        for i in range(offset, min(rows, offset + chunk)):
+            moment = start + timedelta(seconds=i * step)
+            batch.append((moment.strftime("%Y-%m-%d %H:%M:%S"),
+                          'IN' if rng.random() < 0.5 else 'OUT',
+                          f'{rng.randrange(cards):08X}',
+                          'Cho phép' if rng.random() < 0.9 else 'Từ chối',
+                          f'door-{rng.randrange(doors)}'))
+        conn.executemany('INSERT INTO access_log (timestamp, direction, card_uid, status, door) VALUES (?, ?, ?, ?, ?)', batch)
+        conn.commit()
+    conn.close()
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return (time.perf_counter() - start) * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10_000_000)
+    parser.add_argument('--cards', type=int, default=5000)
+    parser.add_argument('--doors', type=int, default=20)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--page', type=int, default=50, help='trang cần lấy khi so sánh OFFSET với cursor')
+    args = parser.parse_args()
+
+    path = os.path.join(os.getcwd(), 'bench_log.db')
+    elapsed, _ = timed(lambda: build_legacy_db(path, args.rows, args.cards, args.doors, args.days))
+    print(f"Tạo {args.rows:,} dòng: {elapsed / 1000:.1f}s ({os.path.getsize(path) / 1e6:.0f} MB)")
+
+    uid = f'{7:08X}'
+    now = datetime.now()
+    month_ago, week_ago = now - timedelta(days=30), now - timedelta(days=7)
+    text = lambda moment: moment.strftime("%Y-%m-%d %H:%M:%S")  # noqa: E731
+    page_size = 100
+
+    legacy = sqlite3.connect(path)
+    before = {
+        'uid 30 ngày': lambda: legacy.execute(
+            'SELECT * FROM access_log WHERE card_uid = ? AND timestamp >= ? AND timestamp < ? ORDER BY id DESC LIMIT ?',
+            (uid, text(month_ago), text(now), page_size)).fetchall(),
+        'từ chối/cửa/giờ 7 ngày': lambda: legacy.execute(
+            "SELECT door, substr(timestamp, 1, 13), COUNT(*) FROM access_log WHERE status = 'Từ chối' "
+            "AND timestamp >= ? AND timestamp < ? GROUP BY 1, 2", (text(week_ago), text(now))).fetchall(),
+        'số lượt/ngày cả năm': lambda: legacy.execute(
+            'SELECT substr(timestamp, 1, 10), COUNT(*) FROM access_log GROUP BY 1').fetchall(),
+        f'trang {args.page} (OFFSET)': lambda: legacy.execute(
+            "SELECT * FROM access_log WHERE status = 'Từ chối' ORDER BY id DESC LIMIT ? OFFSET ?",
+            (page_size, page_size * (args.page - 1))).fetchall(),
+    }
+    results = {name: timed(query)[0] for name, query in before.items()}
+    legacy.close()
+
+    conn = sqlite3.connect(path)
+    elapsed, _ = timed(lambda: app.migrate_access_log(conn))
+    conn.close()
+    print(f"Migration (thêm ts + index): {elapsed / 1000:.1f}s")
+
+    # Bảng tổng hợp trải 365 ngày: tắt lưu trữ để các truy vấn "sau" đo trên đủ dữ liệu
+    system = app.RFIDControlSystem(path, log_retention_days=0)
+    denied = {'status': 'Từ chối'}
+    # Đi theo cursor tới trang cần đo, chỉ tính thời gian của truy vấn trang cuối
+    cursor = None
+    for _ in range(args.page - 1):
+        cursor = system.search_logs(denied, cursor, page_size)[1]
+    after = {
+        'uid 30 ngày': lambda: system.search_logs(
+            {'card_uid': uid, 'from': int(month_ago.timestamp()), 'to': int(now.timestamp())}, None, page_size),
+        'từ chối/cửa/giờ 7 ngày': lambda: system.aggregate_logs(
+            {'status': 'Từ chối', 'from': int(week_ago.timestamp()), 'to': int(now.timestamp())}, ['door', 'hour']),
+        'số lượt/ngày cả năm': lambda: system.aggregate_logs({}, ['day']),
+        f'trang {args.page} (OFFSET)': lambda: system.search_logs(denied, cursor, page_size),
+    }
+    print(f"{'truy vấn':<26} {'trước ms':>10} {'sau ms':>10} {'nhanh hơn':>10}")
+    for name, query in after.items():
+        elapsed, _ = timed(query)
+        label = name.replace('(OFFSET)', '(OFFSET→cursor)')
+        print(f"{label:<26} {results[name]:>10.1f} {elapsed:>10.1f} {results[name] / max(elapsed, 0.001):>9.1f}x")
+    system.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,17 @@
+"""Import app.py cho các benchmark chạy trong cùng tiến trình.
+
+app tạo rfid_log.db (cùng thư mục ảnh, lưu trữ) trong thư mục hiện tại khi
+import, nên chuyển sang một thư mục tạm trước để không đụng dữ liệu thật.
+
+Dùng: from load_app import app. Đường dẫn tương đối trong tham số dòng lệnh
+phải ghép với load_app.invoked_from (thư mục lúc chạy lệnh).
+"""
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+invoked_from = os.getcwd()
+os.chdir(tempfile.mkdtemp())
+import app  # noqa: E402,F401
@@ -0,0 +1,137 @@
+"""Arduino giả trên pseudo-terminal, nói đúng giao thức của code.ino.
+
+Mỗi FakeArduino mở một cặp pty: phía slave là "cổng serial" để app kết nối
+(/api/connect với com_port là đường dẫn in ra), phía master đóng vai Arduino:
+in banner khởi động, gửi "IN:UID:<hex>" / "OUT:UID:<hex>" theo nhịp quét cấu
+hình được, chờ ALLOW/DENY (timeout 5 giây như firmware) rồi mới quét tiếp.
+Độ trễ khứ hồi của từng lượt quét được ghi lại để benchmark.
+
+Nguồn video giả không cần file này: dùng URL camera "synthetic:640x480@30".
+
+Chạy: python benchmarks/simulator.py --controllers 2 --rate 2
+"""
+
+import argparse
+import os
+import pty
+import random
+import select
+import threading
+import time
+import tty
+
+# Giống RESPONSE_TIMEOUT trong code.ino
+RESPONSE_TIMEOUT = 5.0
+
+
+class FakeArduino(threading.Thread):
+    """Một bộ điều khiển cửa giả với hai đầu đọc (IN/OUT)"""
+
+    def __init__(self, uids, rate=1.0, garbled=0.0, seed=None):
+        super().__init__(daemon=True)
+        self.master, self.slave = pty.openpty()
+        # Raw để pty không echo và không đổi \n
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.uids = uids
+        self.rate = rate
+        self.garbled = garbled
+        self.rng = random.Random(seed)
+        self.is_running = True
+        self.buffer = b''
+        # Thống kê
+        self.latencies = []
+        self.replies = {'ALLOW': 0, 'DENY': 0, 'TIMEOUT': 0}
+
+    def println(self, line):
+        # Serial.println() của Arduino kết thúc bằng \r\n
+        os.write(self.master, line.encode() + b'\r\n')
+
+    def read_reply(self, timeout):
+        """Đọc một dòng phản hồi từ app, None nếu hết thời gian"""
+        deadline = time.monotonic() + timeout
+        while b'\n' not in self.buffer:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self.is_running:
+                return None
+            ready, _, _ = select.select([self.master], [], [], min(remaining, 0.5))
+            if ready:
+                try:
+                    self.buffer += os.read(self.master, 1024)
+                except OSError:
+                    return None
+        line, _, self.buffer = self.buffer.partition(b'\n')
+        return line.decode(errors='replace').strip()
+
+    def scan(self):
+        direction = self.rng.choice(('IN', 'OUT'))
+        uid = self.rng.choice(self.uids)
+        frame = f'{direction}:UID:{uid}'
+        if self.garbled and self.rng.random() < self.garbled:
+            # Nhiễu đường truyền: hỏng vài byte của khung
+            frame = frame[:4] + '�' + frame[5:]
+        sent_at = time.perf_counter()
+        self.println(frame)
+        reply = self.read_reply(RESPONSE_TIMEOUT)
+        if reply in ('ALLOW', 'DENY'):
+            self.latencies.append(time.perf_counter() - sent_at)
+            self.replies[reply] += 1
+        else:
+            self.replies['TIMEOUT'] += 1
+            self.println('[ERROR] Timeout! Khong nhan duoc phan hoi tu Python.')
+
+    def run(self):
+        self.println('[INFO] Khoi dong he thong kiem soat ra vao...')
+        self.println('[INFO] He thong san sang. Dang cho quet the...')
+        interval = 1 / self.rate
+        next_scan = time.monotonic()
+        while self.is_running:
+            next_scan += interval
+            delay = next_scan - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # Không theo kịp nhịp (chờ phản hồi lâu): quét tiếp ngay
+                next_scan = time.monotonic()
+            self.scan()
+
+    def stop(self):
+        self.is_running = False
+        if self.is_alive():
+            self.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+
+def make_uids(count, seed=1):
+    rng = random.Random(seed)
+    return [f'{rng.getrandbits(32):08X}' for _ in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--controllers', type=int, default=1)
+    parser.add_argument('--rate', type=float, default=1.0, help='lượt quét/giây của mỗi controller')
+    parser.add_argument('--cards', type=int, default=20, help='số UID ngẫu nhiên được quét')
+    parser.add_argument('--garbled', type=float, default=0.0, help='tỉ lệ khung bị nhiễu')
+    args = parser.parse_args()
+
+    uids = make_uids(args.cards)
+    arduinos = [FakeArduino(uids, args.rate, args.garbled, seed=i) for i in range(args.controllers)]
+    for arduino in arduinos:
+        arduino.start()
+        print(f"Arduino giả sẵn sàng trên {arduino.port}")
+    print("Kết nối từ giao diện với các cổng trên. Camera giả: synthetic:640x480@30. Ctrl+C để dừng.")
+    try:
+        while True:
+            time.sleep(5)
+            for arduino in arduinos:
+                print(f"{arduino.port}: {arduino.replies}")
+    except KeyboardInterrupt:
+        pass
+    for arduino in arduinos:
+        arduino.stop()
+
+
+if __name__ == '__main__':
+    main()
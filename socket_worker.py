@@ -0,0 +1,71 @@
+"""Worker Socket.IO phụ cho chế độ nhiều tiến trình của app.py.
+
+Giữ kết nối Socket.IO của dashboard thay cho gateway: sự kiện gateway phát
+(log, quét thẻ, thẻ thay đổi...) đi qua message queue chung rồi được worker
+đẩy xuống client của mình. Offer WebRTC được chuyển tới /api/webrtc/offer
+của gateway vì camera và aiortc nằm ở đó. Worker không mở serial, camera
+hay DB nên chạy gevent với monkey-patch toàn phần được.
+
+Thường do app.py tự khởi động khi đặt RFID_SOCKET_WORKERS, chạy tay:
+    python socket_worker.py --port 5001 --gateway http://127.0.0.1:5000 --message-queue redis://127.0.0.1:6379/0
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import json
+import logging
+import urllib.error
+import urllib.request
+
+from flask import Flask, request
+from flask_socketio import SocketIO
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('socket_worker')
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--port', type=int, required=True)
+parser.add_argument('--gateway', required=True, help='URL HTTP của app.py')
+parser.add_argument('--message-queue', required=True)
+args = parser.parse_args()
+
+app = Flask(__name__)
+socketio = SocketIO(app, async_mode='gevent', message_queue=args.message_queue, cors_allowed_origins="*")
+
+def post_gateway(path, data):
+    """POST JSON tới gateway, trả về JSON; lỗi HTTP thì raise với message của gateway"""
+    body = json.dumps(data).encode()
+    http_request = urllib.request.Request(args.gateway + path, body, {'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(http_request, timeout=35) as response:
+            return json.load(response)
+    except urllib.error.HTTPError as e:
+        raise RuntimeError(json.load(e).get('message', str(e)))
+
+def forward_offer(sid, data):
+    try:
+        answer = post_gateway('/api/webrtc/offer', dict(data, client_id=sid))
+        socketio.emit('answer', answer, to=sid)
+    except Exception as e:
+        logger.error(f"Lỗi chuyển offer của {sid}: {e}")
+        socketio.emit('error', {'message': f'Lỗi thiết lập WebRTC: {str(e)}'}, to=sid)
+
+def close_connections(sid):
+    try:
+        post_gateway('/api/webrtc/close', {'client_id': sid})
+    except Exception as e:
+        logger.error(f"Lỗi đóng kết nối WebRTC của {sid}: {e}")
+
+@socketio.on('offer')
+def handle_offer(data):
+    socketio.start_background_task(forward_offer, request.sid, data)
+
+@socketio.on('disconnect')
+def handle_disconnect():
+    socketio.start_background_task(close_connections, request.sid)
+
+if __name__ == '__main__':
+    logger.info(f"Worker Socket.IO trên cổng {args.port}, gateway {args.gateway}")
+    socketio.run(app, host='0.0.0.0', port=args.port)